@@ -7,9 +7,9 @@ Created on Mon May  6 11:47:31 2019
 
 import matplotlib.pyplot as plt
 import numpy as np
-from geoprocessing import json_to_dict
-from metrics import threshold, counties_split, county_intersections, preserved_pairs, largest_intersection, min_entropy
-import os
+from results_log import read_pops
+from metrics import threshold, plan_threshold, counties_split, county_intersections, preserved_pairs, largest_intersection, min_entropy
+from mapping import county_contributions, simplified_counties
 import pandas as pd
 import geopandas as gpd
 import seaborn as sns
@@ -27,27 +27,22 @@ FIPS = {
     'KY': '21', 'OR': '41', 'SD': '46'
 }
 
+results_path = 'C:\\Users\\Jacob\\Documents\\GitHub\\county-splits\\Data\\Output\\results\\'
+results = read_pops(results_path)
+
 plans = []
-for state in FIPS:
-    path = f'C:\\Users\\Jacob\\Documents\\GitHub\\county-splits\\Data\\Output\\{state}\\'
-    for file in os.listdir(path):
-        year = int(file[0:4])
-        body = file[5:-5]
-        try:
-            pops = json_to_dict(path+file)
-            num_districts = len(set([key[1] for key in pops]))
-            thresh = 0.005 * sum(pops.values()) / num_districts
-            thresh = min(thresh, 500)
-            pops = threshold(pops, threshold=thresh)
-            
-            plans.append([state, body, year, pops,\
-                          counties_split(pops),\
-                          county_intersections(pops),\
-                          preserved_pairs(pops),\
-                          largest_intersection(pops),\
-                          min_entropy(pops)])
-        except:
-            print(path+file)
+for (state, body, year), pops in results.items():
+    try:
+        pops = threshold(dict(pops), threshold=plan_threshold(pops))
+        
+        plans.append([state, body, year, pops,\
+                      counties_split(pops),\
+                      county_intersections(pops),\
+                      preserved_pairs(pops),\
+                      largest_intersection(pops),\
+                      min_entropy(pops)])
+    except:
+        print(state, body, year)
 plans = np.asarray(plans)
 df = pd.DataFrame(plans, columns = ['state', 'body', 'year', 'pops',\
                                     'counties_split',\
@@ -63,37 +58,20 @@ df.to_csv(f'C:\\Users\\Jacob\\Documents\\GitHub\\county-splits\\Data\\Output\\df
     
 #%%
 PA_county_path = 'C:\\Users\\Jacob\\Documents\\GitHub\\county-splits\\Data\\PA\\'
-json_path = 'C:\\Users\\Jacob\\Documents\\GitHub\\county-splits\\Data\\Output\\PA\\'
 PA_2018_districts = PA_county_path + '2018_congress.shp'
 PA_2016_districts = PA_county_path + '2016_congress.shp'
-geo_df = gpd.read_file(PA_county_path + '2010_counties.shp')
+geo_df = simplified_counties(PA_county_path + '2010_counties.shp', 0.001)
 districts2018 = gpd.read_file(PA_2018_districts) 
 districts2016 = gpd.read_file(PA_2016_districts) 
-dict2018 = json_to_dict(json_path + '2018_congress.json')
-dict2016 = json_to_dict(json_path + '2016_congress.json')
+dict2018 = results[('PA', 'congress', 2018)]
+dict2016 = results[('PA', 'congress', 2016)]
 
 #%%
 
-# get counties
-pops = dict2018
-counties = set([key[0] for key in pops])
-    
-intersect_pops = {county: [pops[key] for key in pops if key[0] == county] \
-                   for county in counties}
-
-good_pairs = {county: sum([i*(i-1)/2 for i in intersect_pops[county]]) \
-              for county in counties }
-
-county_pops = {county: sum([pops[key] for key in pops if key[0] == county]) \
-                   for county in counties}
-
-all_pairs = {county: county_pops[county]*(county_pops[county]-1)/2 \
-              for county in counties }
-
-proportions = {county: good_pairs[county]/all_pairs[county] \
-              for county in counties}
+# probability that two people in each county are in the same district
+proportions = county_contributions(dict2018)['preserved_pairs_within']
 
-df_to_merge = pd.DataFrame(list(proportions.items()), columns=['COUNTYFP10', 'PROP'])
+df_to_merge = proportions.rename('PROP').rename_axis('COUNTYFP10').reset_index()
 geo_df2 = geo_df.merge(df_to_merge, on='COUNTYFP10')
 
 
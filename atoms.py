@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Common refinement ("atoms") of the counties of a state and all of its
+district plans.  Each atom lies in one county and in one district of every
+plan added so far, and carries the block population allocated to it, so the
+county-district populations of any plan are a group-sum over atoms.
+
+The index is kept as two tables:
+    atoms: GeoDataFrame with one row per atom, with columns ATOM (id),
+        COUNTY, one column per plan holding the position of the atom's
+        district in that plan's GeoDataFrame (-1 outside every district),
+        POP and geometry
+    allocation: DataFrame with columns BLOCK (position in b_df), ATOM and
+        POP, holding the population each block contributes to each atom
+"""
+import os
+
+def county_atoms(c_df, b_df, c_county_str='COUNTYFP10', \
+                 b_county_str='COUNTYFP10', pop_str='POP10'):
+    ''' Starts an atom index with one atom per county
+
+    Arguments:
+        c_df: GeoDataFrame of the counties in a state
+        b_df: GeoDataFrame of the blocks in a state
+        c_county_str: name of county column in c_df
+        b_county_str: name of county column in b_df
+        pop_str: the name of the population column in b_df
+
+    Output: atoms and allocation, as described above
+    '''
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+    from geoprocessing import block_county_code
+
+    # every block lies in its county's atom
+    codes = [block_county_code(county, b_df[b_county_str]) \
+             for county in c_df[c_county_str]]
+    atom_of_county = pd.Series(np.arange(len(c_df)), index=codes)
+    block_atoms = atom_of_county.reindex(b_df[b_county_str].to_numpy())
+    allocation = pd.DataFrame({'BLOCK': np.arange(len(b_df)), \
+                               'ATOM': block_atoms.to_numpy(), \
+                               'POP': b_df[pop_str].to_numpy(dtype='float64')})
+    allocation = allocation.dropna(subset=['ATOM'])
+    allocation['ATOM'] = allocation['ATOM'].astype('int64')
+
+    atoms = gpd.GeoDataFrame({'ATOM': np.arange(len(c_df)), \
+                              'COUNTY': c_df[c_county_str].to_numpy()}, \
+                             geometry=c_df.geometry.values, crs=c_df.crs)
+    atoms['POP'] = allocation.groupby('ATOM')['POP'].sum() \
+                             .reindex(atoms['ATOM'], fill_value=0).to_numpy()
+    allocation = allocation.loc[allocation['POP'] > 0].reset_index(drop=True)
+    return atoms, allocation
+
+def add_plan(atoms, allocation, b_df, d_df, plan):
+    ''' Refines an atom index by a new plan.  Only atoms crossed by a district
+    boundary are split, and only the blocks allocated to those atoms are
+    intersected with the new pieces.
+
+    Arguments:
+        atoms: as outputted by county_atoms or add_plan
+        allocation: as outputted by county_atoms or add_plan
+        b_df: GeoDataFrame of the blocks in a state
+        d_df: GeoDataFrame of the districts of the plan
+        plan: name of the plan (example: '2018_congress')
+
+    Output: refined atoms and allocation
+    '''
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+    import shapely as shp
+
+    if plan in atoms.columns:
+        return atoms, allocation
+
+    # split atoms along district boundaries, keeping parts outside districts
+    districts = gpd.GeoDataFrame({plan: np.arange(len(d_df))}, \
+                                 geometry=d_df.geometry.values, crs=d_df.crs)
+    pieces = gpd.overlay(atoms.drop(columns='POP'), districts, \
+                         how='identity', keep_geom_type=True)
+    pieces[plan] = pieces[plan].fillna(-1).astype('int32')
+    pieces = pieces.rename(columns={'ATOM': 'PARENT'})
+    pieces['ATOM'] = np.arange(len(pieces))
+
+    # pass allocations of unsplit atoms straight to their one piece
+    children = pieces.groupby('PARENT')['ATOM']
+    n_children = children.transform('size')
+    only_child = pieces.loc[n_children == 1].set_index('PARENT')['ATOM']
+    whole = allocation['ATOM'].isin(only_child.index)
+    kept = allocation.loc[whole].assign(ATOM=lambda df: \
+                                        only_child.reindex(df['ATOM']) \
+                                        .to_numpy())
+
+    # split the allocations of split atoms by area of overlap
+    pairs = allocation.loc[~whole].reset_index(drop=True) \
+                      .rename(columns={'ATOM': 'PARENT'}) \
+                      .merge(pieces.loc[n_children > 1, ['PARENT', 'ATOM']], \
+                             on='PARENT')
+    block_geoms = b_df.geometry.values[pairs['BLOCK'].to_numpy()]
+    piece_geoms = pieces.geometry.values[pairs['ATOM'].to_numpy()]
+    pairs['AREA'] = shp.area(shp.intersection(block_geoms, piece_geoms))
+
+    # blocks that touch none of the pieces are split by piece area
+    share = pairs.groupby(['BLOCK', 'PARENT'])['AREA'].transform('sum')
+    missing = share == 0
+    if missing.any():
+        pairs.loc[missing, 'AREA'] = shp.area(piece_geoms[missing.to_numpy()])
+        share = pairs.groupby(['BLOCK', 'PARENT'])['AREA'].transform('sum')
+    pairs['POP'] = pairs['POP'] * pairs['AREA'] / share
+    split = pairs.loc[pairs['POP'] > 0, ['BLOCK', 'ATOM', 'POP']]
+
+    allocation = pd.concat([kept, split], ignore_index=True)
+    atoms = pieces.drop(columns='PARENT')
+    atoms['POP'] = allocation.groupby('ATOM')['POP'].sum() \
+                             .reindex(atoms['ATOM'], fill_value=0).to_numpy()
+    return atoms, allocation
+
+def plan_pops(atoms, plan, districts=None):
+    ''' Calculates the population of each county-district intersection of a
+    plan in the index
+
+    Arguments:
+        atoms: as outputted by county_atoms or add_plan
+        plan: name of the plan
+        districts: index of the plan's GeoDataFrame, to name districts by;
+            if None, districts are named by position
+
+    Output: dictionary whose keys are ordered pairs (county, district)
+        and whose values are the populations within these intersections.
+    '''
+    inside = atoms.loc[(atoms[plan] >= 0) & (atoms['POP'] > 0)]
+    sums = inside.groupby(['COUNTY', plan])['POP'].sum()
+    if districts is None:
+        return {(county, int(j)): pop for (county, j), pop in sums.items()}
+    return {(county, districts[j]): pop for (county, j), pop in sums.items()}
+
+def save_atoms(atoms, allocation, directory):
+    ''' Writes an atom index to a folder
+
+    Arguments:
+        atoms: as outputted by county_atoms or add_plan
+        allocation: as outputted by county_atoms or add_plan
+        directory: folder to write atoms.parquet and allocation.parquet to
+    '''
+    os.makedirs(directory, exist_ok=True)
+    atoms.to_parquet(os.path.join(directory, 'atoms.parquet'))
+    allocation.to_parquet(os.path.join(directory, 'allocation.parquet'))
+
+def load_atoms(directory):
+    ''' Reads an atom index written by save_atoms
+
+    Arguments:
+        directory: folder holding atoms.parquet and allocation.parquet
+
+    Output: atoms and allocation
+    '''
+    import pandas as pd
+    import geopandas as gpd
+
+    return gpd.read_parquet(os.path.join(directory, 'atoms.parquet')), \
+           pd.read_parquet(os.path.join(directory, 'allocation.parquet'))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the kernels in kernels.py against the shapely path: the
+area-weighted allocation of split blocks on candidate block-intersection
+pairs, and point-in-polygon classification of block centroids, on
+synthetic pieces and blocks.
+
+usage: python bench_kernels.py [number of points] [number of polygons]
+"""
+import sys
+import time
+import numpy as np
+import shapely as shp
+import kernels
+
+def synthetic_pieces(n_polygons, vertices=256, seed=0):
+    ''' Makes a row of non-overlapping, many-sided polygons with holes
+
+    Arguments:
+        n_polygons: number of polygons
+        vertices: number of vertices on each ring
+        seed: random seed
+
+    Output: array of polygons
+    '''
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2*np.pi, vertices, endpoint=False)
+    polygons = []
+    for i in range(n_polygons):
+        radii = 0.45 + 0.04 * rng.random(vertices)
+        shell = np.column_stack([i + 0.5 + radii * np.cos(angles), \
+                                 0.5 + radii * np.sin(angles)])
+        hole = np.column_stack([i + 0.5 + 0.1 * np.cos(angles), \
+                                0.5 + 0.1 * np.sin(angles)])
+        polygons.append(shp.Polygon(shell, [hole[::-1]]))
+    return np.array(polygons, dtype=object)
+
+def synthetic_pairs(n_blocks, n_keys, pairs_per_block=3, seed=0):
+    ''' Makes candidate block-intersection pairs as block_allocator does,
+    with most blocks entirely in one intersection and the rest split
+
+    Arguments:
+        n_blocks: number of blocks
+        n_keys: number of intersections
+        pairs_per_block: candidate intersections of each block
+        seed: random seed
+
+    Output: pair_block, pair_key, intersect_areas, block_areas, block_pops
+    '''
+    rng = np.random.default_rng(seed)
+    block_areas = rng.uniform(1, 2, n_blocks)
+    block_pops = rng.integers(0, 200, n_blocks).astype('float64')
+    pair_block = np.repeat(np.arange(n_blocks), pairs_per_block)
+    pair_key = rng.integers(0, n_keys, len(pair_block))
+    shares = rng.dirichlet(np.full(pairs_per_block, 0.1), n_blocks).ravel()
+    return pair_block, pair_key, shares * block_areas[pair_block], \
+           block_areas, block_pops
+
+def best_time(function, *args, runs=3):
+    # fastest of several runs, and the output of the last one
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), output
+
+if __name__ == '__main__':
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_polygons = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    backends = ['shapely'] + (['numba'] if kernels.numba is not None else [])
+
+    pairs = synthetic_pairs(n_points, n_polygons)
+    for backend in backends:
+        # compile outside the timed runs
+        kernels.allocate_pairs(*[array[:10] for array in pairs[:3]], \
+                               *pairs[3:], n_polygons, backend)
+        elapsed, totals = best_time(kernels.allocate_pairs, *pairs, \
+                                    n_polygons, backend)
+        if backend == 'shapely':
+            base, base_totals = elapsed, totals
+        print(f'allocate_pairs {backend}: {elapsed:.3f} s,', \
+              f'{base / elapsed:.1f}x shapely,', \
+              f'max population difference', \
+              f'{np.abs(totals - base_totals).max():.2g}')
+
+    rng = np.random.default_rng(1)
+    geoms = synthetic_pieces(n_polygons)
+    xs = rng.uniform(0, n_polygons, n_points)
+    ys = rng.uniform(0, 1, n_points)
+    for backend in backends:
+        kernels.assign_points(xs[:10], ys[:10], geoms, backend)
+        elapsed, labels = best_time(kernels.assign_points, xs, ys, geoms, \
+                                    backend)
+        if backend == 'shapely':
+            base, base_labels = elapsed, labels
+        print(f'assign_points {backend}: {elapsed:.3f} s,', \
+              f'{base / elapsed:.1f}x shapely,', \
+              f'{(labels == base_labels).mean():.4%} of labels agree')
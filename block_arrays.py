@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache of the block fields most stages need (population, county code,
+centroid, bounding box and WKB geometry), stored as .npy files that are
+memory-mapped on load.  Reloading costs almost nothing, and processes that
+map the same files share their pages through the OS page cache.  The arrays
+are made from the blocks as normalized by preprocess.py, so centroids and
+bounds are in the same equal-area CRS as every other layer.
+"""
+import hashlib
+import json
+import os
+
+def write_block_arrays(b_df, directory, county_str='COUNTYFP10', \
+                       pop_str='POP10'):
+    ''' Writes the block arrays of a state to a folder.  The arrays are
+    written to a temporary folder that is then moved into place, so readers
+    never see a partial folder; if the folder is already there (e.g.
+    written by another process at the same time), it is left as it is.
+
+    Arguments:
+        b_df: GeoDataFrame of the blocks in a state
+        directory: folder to write the arrays to
+        county_str: name of county column in b_df
+        pop_str: the name of the population column in b_df
+    '''
+    import numpy as np
+    import shapely as shp
+
+    from preprocess import atomic_path
+    from spatial_index import layer_bounds
+
+    geoms = b_df.geometry.values
+    centroids = shp.centroid(geoms)
+    wkbs = shp.to_wkb(geoms)
+    lengths = np.fromiter((len(wkb) for wkb in wkbs), dtype='int64', \
+                          count=len(wkbs))
+    arrays = {'pop': b_df[pop_str].to_numpy().astype('int32'), \
+              'county': np.asarray(b_df[county_str]).astype('int16'), \
+              'centroid': np.column_stack([shp.get_x(centroids), \
+                                           shp.get_y(centroids)]), \
+              'bounds': layer_bounds(b_df), \
+              'wkb': np.frombuffer(b''.join(wkbs), dtype='uint8'), \
+              'wkb_offsets': np.concatenate([[0], np.cumsum(lengths)])}
+
+    with atomic_path(directory) as temp_dir:
+        os.makedirs(temp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array)
+        with open(os.path.join(temp_dir, 'meta.json'), 'w') as fp:
+            json.dump({'blocks': len(b_df), 'crs': None if b_df.crs is None \
+                       else b_df.crs.to_wkt()}, fp)
+
+def load_block_arrays(directory):
+    ''' Memory-maps the block arrays written by write_block_arrays
+
+    Arguments:
+        directory: folder holding the arrays
+
+    Output: dictionary of read-only arrays
+        pop: population of each block
+        county: county code of each block
+        centroid: (blocks, 2) array of centroid coordinates
+        bounds: (blocks, 4) array of minx, miny, maxx, maxy
+        wkb: WKB of all block geometries, concatenated
+        wkb_offsets: block i's WKB is wkb[wkb_offsets[i]:wkb_offsets[i+1]]
+        along with crs, the CRS of the blocks as WKT (or None)
+    '''
+    import numpy as np
+
+    arrays = {}
+    for name in ['pop', 'county', 'centroid', 'bounds', 'wkb', 'wkb_offsets']:
+        arrays[name] = np.load(os.path.join(directory, name + '.npy'), \
+                               mmap_mode='r')
+    with open(os.path.join(directory, 'meta.json'), 'r') as fp:
+        arrays['crs'] = json.load(fp)['crs']
+    return arrays
+
+def block_geometries(arrays, rows=None):
+    ''' Decodes block geometries from the packed WKB
+
+    Arguments:
+        arrays: as outputted by load_block_arrays
+        rows: positions of the blocks to decode, or None for all blocks
+
+    Output: array of shapely geometries
+    '''
+    import numpy as np
+    import shapely as shp
+
+    offsets = arrays['wkb_offsets']
+    if rows is None:
+        rows = np.arange(len(offsets) - 1)
+    wkb = arrays['wkb']
+    return shp.from_wkb([wkb[offsets[i]:offsets[i+1]].tobytes() \
+                         for i in rows])
+
+def cached_block_arrays(shapefile, cache_dir, county_str='COUNTYFP10', \
+                        pop_str='POP10', preprocessed_dir=None, crs=None):
+    ''' Loads the block arrays of a block shapefile, building them the first
+    time the file is seen from its layer normalized by preprocess.py
+
+    Arguments:
+        shapefile: path to block shapefile
+        cache_dir: folder holding one folder of arrays per input file
+        county_str: name of county column in the shapefile
+        pop_str: the name of the population column in the shapefile
+        preprocessed_dir: folder of normalized layers (see preprocess.py),
+            or None for a preprocessed folder next to the shapefile
+        crs: equal-area CRS to project to, or None for EQUAL_AREA_CRS
+
+    Output: as outputted by load_block_arrays
+    '''
+    from preprocess import file_hash, preprocessed_layer, EQUAL_AREA_CRS
+
+    crs = crs or EQUAL_AREA_CRS
+    if preprocessed_dir is None:
+        preprocessed_dir = os.path.join(os.path.dirname(shapefile), \
+                                        'preprocessed')
+    name = os.path.basename(shapefile)[:-4]
+    key = f'{file_hash(shapefile)} {crs}'
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    directory = os.path.join(cache_dir, f'{name}_{digest}')
+    if not os.path.isdir(directory):
+        from geoprocessing import shrink_blocks
+        b_df = preprocessed_layer(shapefile, preprocessed_dir, crs, \
+                                  [county_str, pop_str])
+        b_df = shrink_blocks(b_df, county_str, pop_str, \
+                             columns=['MINX', 'MINY', 'MAXX', 'MAXY'], \
+                             verbose=False)
+        write_block_arrays(b_df, directory, county_str, pop_str)
+    return load_block_arrays(directory)
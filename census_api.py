@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent, cached queries of the Census API, used in place of the serial
+extract_cb_data_from_census_API in junk.py.
+"""
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from preprocess import atomic_path
+
+CENSUS_URL = 'https://api.census.gov/data'
+
+class RateLimiter:
+    ''' Spaces out requests made from any number of threads so that no more
+    than a fixed number start per second.
+
+    Arguments:
+        rate: maximum number of requests per second
+    '''
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # reserve the next free slot, then sleep until it comes up
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+def get_json(url, limiter=None, retries=3, backoff=1, cache_dir=None, \
+             cache_key=None, timeout=60):
+    ''' Reads JSON from a url, retrying on server and network errors and
+    optionally caching the response on disk.
+
+    Arguments:
+        url: url to query
+        limiter: RateLimiter shared between concurrent callers, or None
+        retries: number of times to retry a failed request
+        backoff: seconds to wait before the first retry, doubled after each
+        cache_dir: directory of cached responses, or None for no cache
+        cache_key: string identifying the response in the cache (defaults
+            to url; pass something without the API key in it)
+        timeout: seconds to wait for the server before giving up on an
+            attempt
+
+    Output: decoded JSON response
+    '''
+    cache_file = None
+    if cache_dir is not None:
+        key = cache_key if cache_key is not None else url
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, name + '.json')
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'r') as fp:
+                return json.load(fp)
+
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                data = json.loads(response.read().decode('utf-8'))
+            break
+        except urllib.error.HTTPError as e:
+            # client errors other than rate limiting will not go away
+            if (e.code < 500 and e.code != 429) or attempt == retries:
+                raise
+        except (OSError, http.client.HTTPException):
+            # unreachable server, timeouts, and connections reset or cut
+            # off part-way through a response
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
+
+    if cache_file is not None:
+        with atomic_path(cache_file) as temp_file, open(temp_file, 'w') as fp:
+            json.dump(data, fp)
+    return data
+
+def census_query_url(fields, geography, within, yr, dataset='dec/sf1', \
+                     key=None, base_url=CENSUS_URL):
+    ''' Builds a Census API url
+
+    Arguments:
+        fields: list of variables to get (example: ['GEO_ID', 'P001001'])
+        geography: geography to get, e.g. 'block group:*'
+        within: enclosing geography, e.g. 'state:42 county:001'
+        yr: year of the dataset
+        dataset: name of the dataset
+        key: Census API key, or None
+        base_url: root of the API, which can be pointed at a local server
+
+    Output: url string
+    '''
+    params = [('get', ','.join(fields)), ('for', geography)]
+    if within:
+        params.append(('in', within))
+    if key is not None:
+        params.append(('key', key))
+    query = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+    return f'{base_url}/{yr}/{dataset}?{query}'
+
+def extract_cb_data_from_census_API(fields, state, yr, key=None, \
+                                    dataset='dec/sf1', workers=8, rate=5, \
+                                    retries=3, backoff=1, cache_dir=None, \
+                                    base_url=CENSUS_URL):
+    ''' Downloads block group data for every county in a state from the
+    Census API, querying the counties concurrently.
+
+    Arguments:
+        fields: list of variables to get (example: ['GEO_ID', 'P001001'])
+        state: two-digit FIPS code of the state
+        yr: year of the dataset
+        key: Census API key, or None
+        dataset: name of the dataset
+        workers: number of concurrent requests
+        rate: maximum number of requests per second
+        retries: number of times to retry a failed request
+        backoff: seconds to wait before the first retry, doubled after each
+        cache_dir: directory of cached responses, or None for no cache
+        base_url: root of the API, which can be pointed at a local server
+
+    Output: DataFrame with one row per block group, including the
+        state, county, tract and block group columns returned by the API
+    '''
+    limiter = RateLimiter(rate)
+
+    def query(get, geography, within):
+        url = census_query_url(get, geography, within, yr, dataset, key, \
+                               base_url)
+        # leave the key out of the cache file name
+        cache_key = census_query_url(get, geography, within, yr, dataset, \
+                                     None, base_url)
+        rows = get_json(url, limiter, retries, backoff, cache_dir, cache_key)
+        return pd.DataFrame(rows[1:], columns=rows[0])
+
+    # get counties in the state
+    counties = query(['NAME'], 'county:*', f'state:{state}')['county']
+
+    # query block groups of all counties at once
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dfs = list(executor.map(lambda county: query(fields, \
+                                     'block group:*', \
+                                     f'state:{state} county:{county}'), \
+                                counties))
+
+    return pd.concat(dfs, ignore_index=True)
@@ -4,91 +4,240 @@ Created on Thu May  2 10:00:54 2019
 
 @author: Jacob
 """
-import geopandas as gpd
 import sys
 import os
-from geoprocessing import county_district_intersection_pops, same_plan, \
-                          dict_to_json
+import socket
+import time
+from geoprocessing import county_district_pop_arrays, same_plan, \
+                          shrink_blocks, groups_from_blocks
+from preprocess import preprocessed_layer, STATE_CRS, EQUAL_AREA_CRS
+from manifest import open_manifest, add_units, resume, run_units, \
+                     pending_units, start_unit, finish_unit, Heartbeat
+from sharding import available_plans, work_units, assign_shards, \
+                     shard_path, merge_shards
+from results_log import ResultsWriter
+from scheduler import schedule, unit_memory, total_memory
+from telemetry import Telemetry
+from overlap import PartitionOverlap
+from spatial_index import layer_bounds, cached_index
 
+# usage:
+#   python cluster_script.py <state> <c|u|l>
+#   python cluster_script.py shard <shard> <number of shards>
+#   python cluster_script.py merge <number of shards>
+#   python cluster_script.py node [memory budget in GB] [workers]
+# input and output folders default to the cluster's, and can be set with the
+# COUNTY_SPLITS_INPUT and COUNTY_SPLITS_OUTPUT environment variables, e.g. to
+# run shards as separate local processes and then merge them
 
-state = sys.argv[1]
-series = sys.argv[2]
+input_path = os.environ.get('COUNTY_SPLITS_INPUT', \
+                            '/scratch/network/jacobmw/Data')
+output_path = os.environ.get('COUNTY_SPLITS_OUTPUT', '/home/jacobmw/Output')
 
-input_path = '/scratch/network/jacobmw/Data'
-output_path = '/home/jacobmw/Output'
+bodies = {'c': 'congress', 'u': 'upper_leg', 'l': 'lower_leg'}
 
+# number of GEOID digits of the groups whose population is assigned whole
+# when they lie in one county-district intersection (12 for block groups,
+# 11 for tracts), or None to look at every block of a split county
+group_level = 12
 
-congresses = ['2018_congress.shp', '2016_congress.shp', '2014_congress.shp', \
-              '2012_congress.shp', '2010_congress.shp', '2008_congress.shp', \
-              '2006_congress.shp', '2004_congress.shp', '2002_congress.shp', \
-              '2000_congress.shp', '1998_congress.shp']
+# unit layers scored against every plan besides counties: name -> (shapefile,
+# column naming the units).  Layers without a shapefile in a state's folder
+# are skipped for that state.
+unit_layers = {'places': ('2010_places', 'GEOID10'), \
+               'vtds': ('2010_vtds', 'GEOID10'), \
+               'school_districts': ('2010_school_districts', 'GEOID10')}
 
-uppers = ['2017_upper_leg.shp', '2016_upper_leg.shp', '2015_upper_leg.shp', \
-          '2014_upper_leg.shp', '2013_upper_leg.shp', '2010_upper_leg.shp', \
-          '2006_upper_leg.shp']
+# state-wide layers of the state being worked on, read in when the first
+# plan needs them
+layers = {}
 
-lowers = ['2017_lower_leg.shp', '2016_lower_leg.shp', '2015_lower_leg.shp', \
-          '2014_lower_leg.shp', '2013_lower_leg.shp', '2010_lower_leg.shp', \
-          '2006_lower_leg.shp']
+def state_unit_layers(state):
+    # the unit layers a state has shapefiles for
+    return {name: (shapefile, id_str) for name, (shapefile, id_str) \
+            in unit_layers.items() \
+            if os.path.isfile(f'{input_path}/{state}/{shapefile}.shp')}
 
-plans = []
-if series == 'c':
-    plans = congresses
-elif series == 'u':
-    plans = uppers
-else:
-    plans = lowers
+def layer(state, name, columns=None):
+    # repaired, equal-area version of one of the state's shapefiles
+    return preprocessed_layer(f'{input_path}/{state}/{name}.shp', \
+                              f'{input_path}/{state}/preprocessed', \
+                              STATE_CRS.get(state, EQUAL_AREA_CRS), columns)
 
-
-# catch errors
-failed = []
-
-try:
-    # get the shapefiles to check
-    shapefiles = [file for file in os.listdir(input_path) if \
-                  file[-4:] == '.shp']
-    shapefiles = [file for file in plans if file in shapefiles]
+def run_plan(state, body, plan, writer):
+    d_df = layer(state, plan)
     
-    # figure out which files we need to check
-    dfs = []
-    dfs_to_test = []
-    for i in plans:
-        dfs.append((i, gpd.read_file(f'{input_path}/{state}/{i}')))
-    for i in range(len(dfs)):
-        if i == 0:
-            dfs_to_test.append(dfs[i])
-        else:
-            df = dfs[i][1]
-            df_last = dfs[i-1][1]
-            if not same_plan(df, df_last):
-                dfs_to_test.append(dfs[i])
-
-    # run tests
-    # c_df = gpd.read_file(f'{input_path}/{state}/2010_counties.shp')
-    # b_df = gpd.read_file(f'{input_path}/{state}/2010_blocks.shp')
-    for plan_name, d_df in dfs_to_test:
-      #  _, pops = county_district_intersection_pops(c_df, d_df, b_df)
+    # skip plans that are the same as the previous one
+    plans = available_plans(input_path, state, body)
+    i = plans.index(plan)
+    if i > 0:
+        d_df_last = layer(state, plans[i-1])
+        if same_plan(d_df, d_df_last, n_threads=None):
+            return None
+    
+    if layers.get('state') != state:
+        layers.clear()
+        layers['c_df'] = layer(state, '2010_counties')
+        b_df = shrink_blocks(layer(state, '2010_blocks', \
+                                   ['COUNTYFP10', 'POP10', 'GEOID10']), \
+                             columns=['AREA', 'MINX', 'MINY', 'MAXX', 'MAXY', \
+                                      'GEOID10'])
+        layers['groups'] = None if group_level is None else \
+                           groups_from_blocks(b_df, level=group_level)
+        layers['b_df'] = b_df.drop(columns='GEOID10')
         
-        # write to file
-        if not os.path.isdir(output_path):
-            os.mkdir(output_path)
-        if not os.path.isdir(f'{output_path}/{state}'):
-            os.mkdir(f'{output_path}/{state}')
-            
-        pops = {}
-        pops[1] = 2
-        pops[3] = 4
-        pops_file = f'{output_path}/{state}/{plan_name[:-4]}.json'
-        dict_to_json(pops, pops_file)
-except:
-    failed.append(f'{state} {plan_name}')
+        # one block index for every plan of the state and every unit layer
+        layers['block_index'] = cached_index(layer_bounds(layers['b_df']), \
+                                             f'{input_path}/{state}/indexes', \
+                                             'blocks')
+        
+        # the unit of each block in the other unit layers is found once
+        layers['overlap'] = None
+        if state_unit_layers(state):
+            layers['overlap'] = PartitionOverlap(layers['b_df'], \
+                                    area_str='AREA', n_threads=None, \
+                                    backend='auto', \
+                                    block_index=layers['block_index'])
+            for name, (shapefile, id_str) in state_unit_layers(state).items():
+                layers['overlap'].add_units(name, \
+                                            layer(state, shapefile, [id_str]), \
+                                            id_str)
+        layers['state'] = state
+    start = time.time()
+    # only populations are kept, so intersections are released county by
+    # county rather than held for the whole plan
+    arrays = county_district_pop_arrays(layers['c_df'], d_df, \
+                                        layers['b_df'], area_str='AREA', \
+                                   index_dir=f'{input_path}/{state}/indexes', \
+                                   n_threads=None, groups=layers['groups'], \
+                                   backend='auto', \
+                                   block_index=layers['block_index'])
+    pops = dict(zip(zip(arrays['county'].tolist(), \
+                        arrays['district'].tolist()), \
+                    arrays['population'].tolist()))
+    
+    # append to this worker's results log
+    writer.write(state, body, int(plan[:4]), pops, time.time() - start)
     
-# write failed file if needed
-if len(failed) > 0:
-    with open(f'{output_path}/{state}/failed.txt', 'w') as f:
-        for item in failed:
-            f.write('%s\n' % item)
+    # the same plan against the state's other unit layers
+    overlap = layers['overlap']
+    if overlap is not None:
+        overlap.add_plan(plan, d_df)
+        for units in overlap.units:
+            start = time.time()
+            writer.write(state, body, int(plan[:4]), \
+                         overlap.pops(units, plan), time.time() - start, \
+                         units=units)
+        overlap.drop_plan(plan)
+    
+    # counts for telemetry
+    return {'blocks': len(layers['b_df']), 'intersections': len(pops)}
+
+def run(units, run_output_path, state=None, body=None):
+    # record every unit in the manifest, then run whatever is not done yet,
+    # including units that failed or were cut off in an earlier run
+    os.makedirs(run_output_path, exist_ok=True)
+    conn = open_manifest(f'{run_output_path}/manifest.db')
+    add_units(conn, units)
+    resume(conn, state, body)
+    n_units = len(pending_units(conn, state, body))
+    with Telemetry(f'{run_output_path}/metrics.prom', n_units) as telemetry, \
+         ResultsWriter(f'{run_output_path}/results') as writer:
+        def work(*unit):
+            telemetry.unit_started(unit)
+            try:
+                stats = run_plan(*unit, writer)
+            except Exception as e:
+                telemetry.unit_finished(unit, error=repr(e))
+                raise
+            telemetry.unit_finished(unit, stats)
+        return run_units(conn, work, state, body)
 
+def run_scheduled(units, run_output_path, budget, max_workers=None):
+    # like run, but running units in parallel under a memory budget
+    os.makedirs(run_output_path, exist_ok=True)
+    conn = open_manifest(f'{run_output_path}/manifest.db')
+    add_units(conn, units)
+    resume(conn)
+    pending = pending_units(conn)
+    memory = {unit: unit_memory(input_path, unit[0], unit[2], \
+                                [shapefile for shapefile, _ in \
+                                 state_unit_layers(unit[0]).values()]) \
+              for unit in pending}
     
+    # each state's units run one after another in one worker, which keeps
+    # the state's layers and a results writer named after the host and
+    # state for all of them
+    writers = {}
+    def work(unit):
+        if unit[0] not in writers:
+            writers[unit[0]] = ResultsWriter(f'{run_output_path}/results', \
+                                    f'{socket.gethostname()}-{unit[0]}')
+        return run_plan(*unit, writers[unit[0]])
+    
+    def close_writers():
+        # closed segments can be compacted
+        for writer in writers.values():
+            writer.close()
+    
+    def started(unit, pid):
+        start_unit(conn, unit)
+        telemetry.unit_started(unit, pid)
+    
+    def finished(unit, error, peak, stats):
+        finish_unit(conn, unit, error)
+        telemetry.unit_finished(unit, stats, error)
+        if peak is not None:
+            print(f'{unit[0]} {unit[2]}: estimated ' \
+                  f'{memory[unit] / 2**20:.0f} MB, peak {peak / 2**20:.0f} MB')
+    
+    # units are leased to this process, so other jobs sharing the manifest
+    # leave them alone while it runs
+    with Telemetry(f'{run_output_path}/metrics.prom', len(pending)) \
+         as telemetry, Heartbeat(conn):
+        return schedule(pending, memory, work, budget, max_workers, \
+                        started, finished, group=lambda unit: unit[0], \
+                        finish=close_writers)
 
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'shard':
+        shard = int(sys.argv[2])
+        n_shards = int(sys.argv[3])
+        states = sorted(os.listdir(input_path))
+        units = assign_shards(work_units(input_path, states), n_shards)[shard]
+        failed = run(units, shard_path(output_path, shard))
+        failed_file = f'{shard_path(output_path, shard)}/failed.txt'
+    
+    elif sys.argv[1] == 'merge':
+        n_shards = int(sys.argv[2])
+        states = sorted(os.listdir(input_path))
+        problems = merge_shards(output_path, work_units(input_path, states), \
+                                n_shards)
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    
+    elif sys.argv[1] == 'node':
+        budget = float(sys.argv[2]) * 2**30 if len(sys.argv) > 2 else \
+                 0.8 * total_memory()
+        max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        states = sorted(os.listdir(input_path))
+        units = sorted(work_units(input_path, states))
+        failed = run_scheduled(units, output_path, budget, max_workers)
+        failed_file = f'{output_path}/failed.txt'
+    
+    else:
+        state = sys.argv[1]
+        body = bodies.get(sys.argv[2], 'lower_leg')
+        units = [(state, body, plan) for plan in \
+                 available_plans(input_path, state, body)]
+        failed = run(units, output_path, state, body)
+        failed_file = f'{output_path}/{state}/failed.txt'
     
+    # write failed file if needed
+    if len(failed) > 0:
+        os.makedirs(os.path.dirname(failed_file), exist_ok=True)
+        with open(failed_file, 'w') as f:
+            for item in failed:
+                f.write('%s %s\n' % (item[0], item[2]))
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that faster ways of computing county-district populations agree with
+the original county_district_intersection_pops, kept here as the legacy
+engine.  Each candidate engine is run on the same plans as the legacy
+engine, real or synthetic, and the populations and every split metric are
+compared.  A plan passes if the largest population difference and every
+metric difference are within tolerance; the exit code is nonzero if any
+plan fails, so a release can be gated on it.
+
+By default only the engines meant to reproduce production exactly are
+checked.  Engines that approximate it are opt-in, each with its own
+tolerance.
+
+usage:
+    python equivalence.py synthetic [number of plans] [options]
+    python equivalence.py <input folder> <state> <c|u|l> [options]
+options:
+    --engines=groups,threads    candidate engines to check (default: the
+                                exact engines)
+    --approximate               also check the approximate engines
+    --report=report.json        also write the report to a JSON file
+"""
+import json
+import sys
+import time
+from metrics import threshold, plan_threshold, split_metrics
+
+# The legacy engine is a frozen copy of county_district_intersection_pops as
+# it was before any of the faster engines were written, so that rewriting
+# geoprocessing.py cannot change the reference the engines are checked
+# against.  Do not optimize it.
+
+def legacy_intersections(c_df, d_df, county_str):
+    # get_county_district_intersections as it was
+    from rtree import index
+
+    intersections = {}
+    idx = index.Index()
+    for i, county in c_df.iterrows():
+        idx.insert(i, county['geometry'].bounds)
+    for j, district in d_df.iterrows():
+        for i, county in c_df.iterrows():
+            county_geom = county['geometry']
+            district_geom = district['geometry']
+            if i in idx.intersection(district_geom.bounds):
+                intersection = county_geom.intersection(district_geom)
+                if not intersection.is_empty:
+                    intersections[(county[county_str], j)] = intersection
+    return intersections
+
+def legacy_pops(intersections, b_df, county_str, pop_str):
+    # get_pops_of_intersections as it was
+    from rtree import index
+
+    pops = {}
+    for key in intersections:
+        pops[key] = 0
+    counties = list(set([key[0] for key in intersections]))
+    for county in counties:
+        used = []
+        cblocks_df = b_df.loc[b_df[county_str] == county]
+        county_intersections = [key for key in pops if key[0] == county]
+        if len(county_intersections) == 1:
+            intersection = county_intersections[0]
+            block_pops = list(cblocks_df.loc[:, pop_str])
+            pops[intersection] = pops[intersection] + sum(block_pops)
+        else:
+            idx = index.Index()
+            for i, block in cblocks_df.iterrows():
+                idx.insert(i, block['geometry'].bounds)
+            for i, block in cblocks_df.iterrows():
+                block_geom = block['geometry']
+                block_area = block_geom.area
+                block_pop = int(block[pop_str])
+                for key in county_intersections:
+                    geom = intersections[key]
+                    if geom is not None:
+                        bounds = geom.bounds
+                        if i not in used and i in idx.intersection(bounds):
+                            intersect_area = geom.intersection(block_geom).area
+                            proportion = intersect_area/block_area
+                            pop_to_add = block_pop * proportion
+                            pops[key] = pops[key] + pop_to_add
+                            if proportion > 0.99:
+                                used.append(i)
+    to_remove = [key for key in pops if pops[key] == 0]
+    for key in to_remove:
+        pops.pop(key, None)
+    return pops
+
+def legacy_engine(c_df, d_df, b_df, cache):
+    intersections = legacy_intersections(c_df, d_df, 'COUNTYFP10')
+    return legacy_pops(intersections, b_df, 'COUNTYFP10', 'POP10')
+
+def arrays_to_pops(arrays):
+    # pops dictionary from the output of county_district_pop_arrays
+    return dict(zip(zip(arrays['county'].tolist(), \
+                        arrays['district'].tolist()), \
+                    arrays['population'].tolist()))
+
+def streaming_engine(c_df, d_df, b_df, cache):
+    from geoprocessing import county_district_pop_arrays
+    return arrays_to_pops(county_district_pop_arrays(c_df, d_df, b_df))
+
+def threads_engine(c_df, d_df, b_df, cache):
+    from geoprocessing import county_district_pop_arrays
+    return arrays_to_pops(county_district_pop_arrays(c_df, d_df, b_df, \
+                                                     n_threads=None))
+
+def kernels_engine(c_df, d_df, b_df, cache):
+    from geoprocessing import county_district_pop_arrays
+    return arrays_to_pops(county_district_pop_arrays(c_df, d_df, b_df, \
+                                                     backend='auto'))
+
+def groups_engine(c_df, d_df, b_df, cache):
+    from geoprocessing import county_district_pop_arrays, groups_from_blocks
+    if 'groups' not in cache:
+        cache['groups'] = groups_from_blocks(b_df)
+    return arrays_to_pops(county_district_pop_arrays(c_df, d_df, b_df, \
+                                                     groups=cache['groups']))
+
+def atoms_engine(c_df, d_df, b_df, cache):
+    from atoms import county_atoms, add_plan, plan_pops
+    if 'atoms' not in cache:
+        cache['atoms'] = county_atoms(c_df, b_df)
+        cache['plans'] = 0
+    # each plan refines the index further, as in a batch run
+    cache['plans'] += 1
+    plan = f'plan_{cache["plans"]}'
+    cache['atoms'] = add_plan(*cache['atoms'], b_df, d_df, plan)
+    return plan_pops(cache['atoms'][0], plan, d_df.index)
+
+def overlap_engine(c_df, d_df, b_df, cache):
+    from overlap import PartitionOverlap
+    if 'overlap' not in cache:
+        # blocks carry their county, as in the legacy engine
+        cache['overlap'] = PartitionOverlap(b_df)
+        cache['overlap'].add_units('counties', c_df, 'COUNTYFP10', \
+                                   'COUNTYFP10')
+        cache['plans'] = 0
+    cache['plans'] += 1
+    plan = f'plan_{cache["plans"]}'
+    cache['overlap'].add_plan(plan, d_df)
+    pops = cache['overlap'].pops('counties', plan)
+    cache['overlap'].drop_plan(plan)
+    return pops
+
+# candidate engines; each is called with the counties, districts and blocks
+# of a plan and a dictionary it may keep state-wide work in between plans.
+# These should agree with legacy up to floating-point rounding.
+ENGINES = {'streaming': streaming_engine, 'threads': threads_engine, \
+           'kernels': kernels_engine, 'groups': groups_engine, \
+           'overlap': overlap_engine}
+
+# engines that only approximate legacy, with the largest population and
+# metric differences allowed for them on the synthetic plans.  atoms
+# allocates split blocks by area share alone, without legacy's early stop
+# once 99% of a block is allocated, so it differs by a few people per split
+# block.
+APPROXIMATE_ENGINES = {'atoms': atoms_engine}
+TOLERANCES = {'atoms': (5, 1e-4)}
+
+def synthetic_plans(n_plans, size=60, n_counties=6, n_districts=8, seed=0):
+    ''' Makes a synthetic state of square blocks in strips of counties, and
+    district plans drawn as Voronoi cells of random points, so that
+    districts cut through counties, block groups and blocks
+
+    Arguments:
+        n_plans: number of plans
+        size: the state is size x size blocks
+        n_counties: number of counties
+        n_districts: number of districts in each plan
+        seed: random seed
+
+    Output: counties, blocks, and a list of (name, districts) of the plans
+    '''
+    import numpy as np
+    import geopandas as gpd
+    import shapely as shp
+
+    rng = np.random.default_rng(seed)
+    cols, rows = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    cols = cols.ravel()
+    rows = rows.ravel()
+    county = cols * n_counties // size
+    county_codes = np.array([f'{2*c+1:03d}' for c in range(n_counties)])
+
+    # block groups are runs of 10 blocks in a column, tracts are columns
+    geoids = [f'99{county_codes[c]}{i:06d}{j // 10}{j:03d}' \
+              for c, i, j in zip(county, cols, rows)]
+    b_df = gpd.GeoDataFrame({'COUNTYFP10': county_codes[county], \
+                             'POP10': rng.integers(0, 200, len(cols)) * \
+                                      (rng.random(len(cols)) > 0.1), \
+                             'GEOID10': geoids}, \
+                            geometry=shp.box(cols, rows, cols + 1, rows + 1))
+
+    edges = [c * size // n_counties for c in range(n_counties + 1)]
+    c_df = gpd.GeoDataFrame({'COUNTYFP10': county_codes}, \
+                            geometry=[shp.box(edges[c], 0, edges[c+1], size) \
+                                      for c in range(n_counties)])
+
+    state = shp.box(0, 0, size, size)
+    plans = []
+    for p in range(n_plans):
+        points = shp.multipoints(rng.uniform(0, size, (n_districts, 2)))
+        cells = shp.get_parts(shp.voronoi_polygons(points, extend_to=state))
+        d_df = gpd.GeoDataFrame({'DISTRICT': np.arange(len(cells))}, \
+                                geometry=shp.intersection(cells, state))
+        plans.append((f'synthetic_{p}', d_df))
+    return c_df, b_df, plans
+
+def state_plans(input_path, state, body):
+    ''' Reads the counties, blocks and plans of a state the way
+    cluster_script.py does
+
+    Arguments:
+        input_path: folder holding one folder of shapefiles per state
+        state: two-letter abbreviation of the state
+        body: 'congress', 'upper_leg' or 'lower_leg'
+
+    Output: counties, blocks, and a list of (name, districts) of the plans
+    '''
+    from geoprocessing import shrink_blocks
+    from preprocess import preprocessed_layer, STATE_CRS, EQUAL_AREA_CRS
+    from sharding import available_plans
+
+    def layer(name, columns=None):
+        return preprocessed_layer(f'{input_path}/{state}/{name}.shp', \
+                                  f'{input_path}/{state}/preprocessed', \
+                                  STATE_CRS.get(state, EQUAL_AREA_CRS), \
+                                  columns)
+
+    c_df = layer('2010_counties')
+    b_df = shrink_blocks(layer('2010_blocks', \
+                               ['COUNTYFP10', 'POP10', 'GEOID10']), \
+                         columns=['GEOID10'], verbose=False)
+    plans = [(plan, layer(plan)) for plan in \
+             available_plans(input_path, state, body)]
+    return c_df, b_df, plans
+
+def compare(reference, candidate, pop_tolerance=1e-3, metric_tolerance=1e-9):
+    ''' Compares the pops and split metrics of two engines on one plan.
+    Both are thresholded with the reference's threshold before computing
+    metrics.
+
+    Arguments:
+        reference: pops from the legacy engine
+        candidate: pops from the candidate engine
+        pop_tolerance: largest allowed difference in the population of an
+            intersection, in people
+        metric_tolerance: largest allowed difference in any metric
+
+    Output: dictionary of the largest population difference, the
+        intersection it is at, the number of intersections found by only
+        one engine, the difference in each metric, and whether the plan
+        passed
+    '''
+    keys = list(reference) + [key for key in candidate \
+                              if key not in reference]
+    differences = [abs(reference.get(key, 0) - candidate.get(key, 0)) \
+                   for key in keys]
+    worst = max(range(len(keys)), key=differences.__getitem__, default=None)
+    only_one = sum(1 for key in keys if (key in reference) != \
+                   (key in candidate))
+
+    thresh = plan_threshold(reference) if reference else 0
+    reference_metrics = split_metrics(threshold(dict(reference), thresh))
+    candidate_metrics = split_metrics(threshold(dict(candidate), thresh)) \
+                        if candidate else {}
+    metric_differences = {metric: abs(value - candidate_metrics[metric]) \
+                          if metric in candidate_metrics else float('inf') \
+                          for metric, value in reference_metrics.items()}
+
+    max_difference = differences[worst] if worst is not None else 0
+    # differences of exactly zero population count as agreeing
+    passed = max_difference <= pop_tolerance and \
+             all(difference <= metric_tolerance for difference in \
+                 metric_differences.values())
+    return {'max_pop_difference': float(max_difference), \
+            'worst_intersection': None if worst is None else \
+                                  [str(part) for part in keys[worst]], \
+            'intersections_in_one_engine': only_one, \
+            'metric_differences': {metric: float(difference) for metric, \
+                                   difference in metric_differences.items()}, \
+            'passed': passed}
+
+def run_equivalence(c_df, b_df, plans, engines=ENGINES, \
+                    pop_tolerance=1e-3, metric_tolerance=1e-9, \
+                    tolerances=TOLERANCES):
+    ''' Runs the legacy engine and each candidate engine on every plan and
+    compares them.  Times include any state-wide work a candidate does on
+    its first plan.
+
+    Arguments:
+        c_df: GeoDataFrame of the counties in a state
+        b_df: GeoDataFrame of the blocks in a state
+        plans: list of (name, districts GeoDataFrame) of the plans
+        engines: dictionary of candidate engines, as in ENGINES
+        pop_tolerance, metric_tolerance: as in compare
+        tolerances: dictionary of (pop_tolerance, metric_tolerance) of
+            engines that are allowed other tolerances, as in TOLERANCES
+
+    Output: list of one dictionary per plan and engine, with the plan,
+        engine, times, speedup and the output of compare
+    '''
+    caches = {name: {} for name in engines}
+    report = []
+    for plan, d_df in plans:
+        start = time.perf_counter()
+        reference = legacy_engine(c_df, d_df, b_df, {})
+        legacy_seconds = time.perf_counter() - start
+        for name, engine in engines.items():
+            start = time.perf_counter()
+            try:
+                candidate = engine(c_df, d_df, b_df, caches[name])
+                error = None
+            except Exception as e:
+                candidate = {}
+                error = repr(e)
+            seconds = time.perf_counter() - start
+            row = {'plan': plan, 'engine': name, \
+                   'legacy_seconds': legacy_seconds, 'seconds': seconds, \
+                   'speedup': legacy_seconds / max(seconds, 1e-9)}
+            row.update(compare(reference, candidate, \
+                               *tolerances.get(name, (pop_tolerance, \
+                                                      metric_tolerance))))
+            if error is not None:
+                row['error'] = error
+                row['passed'] = False
+            report.append(row)
+    return report
+
+def print_report(report):
+    # one line per plan and engine, then a summary line
+    for row in report:
+        worst = max(row['metric_differences'].items(), key=lambda x: x[1], \
+                    default=('none', 0))
+        print(f"{'PASS' if row['passed'] else 'FAIL'} {row['plan']} " \
+              f"{row['engine']}: {row['speedup']:.2f}x " \
+              f"({row['legacy_seconds']:.2f} s -> {row['seconds']:.2f} s), " \
+              f"max pop difference {row['max_pop_difference']:.3g}, " \
+              f"max metric difference {worst[1]:.3g} ({worst[0]})" \
+              + (f", error {row['error']}" if 'error' in row else ''))
+    failed = sum(1 for row in report if not row['passed'])
+    print(f'{len(report) - failed} passed, {failed} failed')
+
+if __name__ == '__main__':
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] \
+                   if arg.startswith('--') and '=' in arg)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    known = {**ENGINES, **APPROXIMATE_ENGINES}
+    engines = dict(ENGINES) if 'engines' not in options else \
+              {name: known[name] for name in options['engines'].split(',')}
+    if '--approximate' in sys.argv[1:]:
+        engines.update(APPROXIMATE_ENGINES)
+
+    if args[0] == 'synthetic':
+        c_df, b_df, plans = synthetic_plans(int(args[1]) if len(args) > 1 \
+                                            else 3)
+    else:
+        bodies = {'c': 'congress', 'u': 'upper_leg', 'l': 'lower_leg'}
+        c_df, b_df, plans = state_plans(args[0], args[1], bodies[args[2]])
+
+    report = run_equivalence(c_df, b_df, plans, engines)
+    print_report(report)
+    if 'report' in options:
+        with open(options['report'], 'w') as f:
+            json.dump(report, f, indent=1)
+    sys.exit(0 if all(row['passed'] for row in report) else 1)
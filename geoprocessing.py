@@ -5,50 +5,66 @@ Created on Sat Mar 16 17:46:38 2019
 @author: Jacob
 """
 
-import shapely as shp
-import geopandas as gpd
-import pandas as pd
-import json
-from shapely.ops import cascaded_union
-from rtree import index
-
-def get_county_district_intersections(c_df, d_df, county_str):
+# shapely, geopandas, pandas, numpy and rtree are imported inside the
+# functions that use them, so that importing this module stays cheap for
+# processes that only read and score results
+from pops_io import dict_to_json, json_to_dict
+
+def get_county_district_intersections(c_df, d_df, county_str, \
+                                      index_dir=None, n_threads=1):
     ''' Finds geometric intersections of c_df and d_df
     
     Arguments: 
         c_df: GeoDataFrame of the counties in a state
         d_df: GeoDataFrame of the d_df in a state
         county_str: name of county column in c_df
+        index_dir: folder of stored spatial indexes (see spatial_index.py),
+            or None to build the county index in memory
+        n_threads: number of threads to intersect geometries in (see
+            parallel.py), None for one per core
         
     Output: dictionary whose keys are ordered pairs (county, district)
         and whose values are the geometries corresponding to the intersections.
 
     '''
+    import numpy as np
+    from parallel import intersection
+    from spatial_index import layer_bounds, build_index, cached_index
+
     # initialize dictionary to be returned
     intersections = {}
     
-    # initialize r-tree index
-    idx = index.Index()
+    # bulk-load R-tree index with bounds of c_df, by row position
+    bounds = layer_bounds(c_df)
+    if index_dir is None:
+        idx = build_index(bounds)
+    else:
+        idx = cached_index(bounds, index_dir, 'counties')
     
-    # populate R-tree index with bounds of c_df
-    for i, county in c_df.iterrows():
-        idx.insert(i, county['geometry'].bounds)
+    # use rtree to quickly eliminate many cases, keeping the candidate
+    # (county, district) pairs by row position
+    county_i = []
+    district_j = []
+    for j, district_geom in enumerate(d_df.geometry):
+        for i in sorted(idx.intersection(district_geom.bounds)):
+            county_i.append(i)
+            district_j.append(j)
+    county_i = np.array(county_i, dtype='int64')
+    district_j = np.array(district_j, dtype='int64')
     
     # find intersections
-    for j, district in d_df.iterrows():
-        for i, county in c_df.iterrows():
-            county_geom = county['geometry']
-            district_geom = district['geometry']
-            # use rtree to quickly eliminate many cases
-            if i in idx.intersection(district_geom.bounds):
-                intersection = county_geom.intersection(district_geom)
-                if not intersection.is_empty:
-                    intersections[(county[county_str], j)] = intersection
-                    
+    pieces = intersection(c_df.geometry.values[county_i], \
+                          d_df.geometry.values[district_j], n_threads)
+    counties = c_df[county_str].tolist()
+    for i, j, piece in zip(county_i, district_j, pieces):
+        if not piece.is_empty:
+            intersections[(counties[i], d_df.index[j])] = piece
     
     return intersections
 
-def get_pops_of_intersections(intersections, b_df, county_str, pop_str):
+def get_pops_of_intersections(intersections, b_df, county_str, pop_str, \
+                              area_str=None, index_dir=None, n_threads=1, \
+                              groups=None, backend='shapely'):
     ''' Calculates population of each county-district intersection,
     based on block group populations.
     
@@ -60,6 +76,19 @@ def get_pops_of_intersections(intersections, b_df, county_str, pop_str):
         b_df: GeoDataFrame of the census blocks in a state
         county_str: name of county column in c_df
         pop_str: the name of the population column in b_df
+        area_str: the name of a column in b_df with precomputed block areas
+            (see preprocess.py), or None to compute areas here
+        index_dir: folder of stored spatial indexes (see spatial_index.py),
+            or None to build the block index in memory
+        n_threads: number of threads to intersect geometries in (see
+            parallel.py), None for one per core
+        groups: block groups (or tracts) as outputted by groups_from_blocks,
+            or None.  If given, groups lying entirely within one
+            intersection are assigned their total population at once, and
+            only the blocks of the other groups are looked at.
+        backend: 'shapely' to add up split blocks in Python, 'numba' to use
+            the compiled kernel in kernels.py, or 'auto' to use it if numba
+            is installed
         
     Output: dictionary whose keys are ordered pairs (county, district)
         and whose values are the populations within these intersections.
@@ -78,79 +107,163 @@ def get_pops_of_intersections(intersections, b_df, county_str, pop_str):
         of the block group proportionally to intersections that were found,
         so as to preserve the total population of the state.
     '''
+    allocate = block_allocator(b_df, county_str, pop_str, area_str, \
+                               index_dir, n_threads, groups, backend)
 
     # initialize population dictionary to 0 at all intersections
     pops = {}
     for key in intersections:
         pops[key] = 0
-        
-       
+    
     # iterate over counties
     counties = list(set([key[0] for key in intersections]))
-    
     for county in counties:
+        pops.update(allocate(county, {key: intersections[key] for key \
+                                      in intersections if key[0] == county}))
+                
+    # remove keys with no population
+    to_remove = [key for key in pops if pops[key] == 0]
+    for key in to_remove:
+        pops.pop(key, None)
+    return intersections, pops
+
+def block_allocator(b_df, county_str, pop_str, area_str=None, \
+                    index_dir=None, n_threads=1, groups=None, \
+                    backend='shapely', block_index=None):
+    ''' Sets up allocating the block populations of a state to
+    county-district intersections one county at a time, as described in
+    get_pops_of_intersections, so that the intersections of a county can be
+    thrown away once its populations are known.
+    
+    Arguments: 
+        b_df, county_str, pop_str, area_str, index_dir, n_threads, groups,
+            backend: as in get_pops_of_intersections
+        block_index: R-tree index of the rows of b_df to share with other
+            allocators, or None to build one when first needed
         
-        # initialize list for used blocks
-        used = []
+    Output: function taking a county and a dictionary of the intersections
+        of that county (as in get_county_district_intersections), and
+        returning a dictionary of their populations
+    '''
+    import numpy as np
+    from parallel import area, intersection_area
+    from spatial_index import layer_bounds, build_index, cached_index
+
+    # find the rows of each county once, rather than comparing the county
+    # column against every county in turn
+    county_rows = b_df.groupby(county_str, observed=True).indices
+    
+    # one R-tree index of all blocks in the state, by row position, built
+    # lazily since unsplit counties do not need it
+    idx = block_index
+    
+    # the same for block groups
+    if groups is not None:
+        g_df, block_groups = groups
+        group_rows = g_df.groupby(county_str, observed=True).indices
+        group_pops = g_df[pop_str].to_numpy()
+    
+    def allocate(county, intersections):
+        nonlocal idx
+        pops = {key: 0 for key in intersections}
         
         # cut down the block dataframe to what is necessary
-        cblocks_df = b_df.loc[b_df[county_str] == county]
+        rows = county_rows.get(block_county_code(county, b_df[county_str]), [])
+        cblocks_df = b_df.iloc[rows]
         
         # shortcut if county is not split
-        county_intersections = [key for key in pops if key[0] == county]
+        county_intersections = list(pops)
         if len(county_intersections) == 1:
             intersection = county_intersections[0]
             block_pops = list(cblocks_df.loc[:, pop_str])
             pops[intersection] = pops[intersection] + sum(block_pops)
-            
-        else:
-            
-            # initialize r-tree index
-            idx = index.Index()
-            
-            # populate R-tree index with bounds of block groups
-            for i, block in cblocks_df.iterrows():
-                idx.insert(i, block['geometry'].bounds)
-            
-            # iterate over block groups
-            for i, block in cblocks_df.iterrows():
-                
-                # get block data once 
-                block_geom = block['geometry']
-                block_area = block_geom.area
-                block_pop = int(block[pop_str])                                
-     
-                for key in county_intersections:
-                    # get geometry of county-district intersection
-                    geom = intersections[key]
-                    if geom is not None:
-                        bounds = geom.bounds
-                        # use rtree to filter out a whole bunch of cases
-                        if i not in used and i in idx.intersection(bounds):
-                            # get intersection of block group with county-district
-                            # overlap, will be zero or entire block group most of the
-                            # time, if block group is split, assume population is 
-                            # uniform over area
-                            
-                            intersect_area = geom.intersection(block_geom).area
-                            proportion = intersect_area/block_area
-                            # population to add
-                            pop_to_add = block_pop * proportion
-                            pops[key] = pops[key] + pop_to_add
-                            # mark as used
-                            if proportion > 0.99:
-                                used.append(i)
-                
-    # remove keys with no population
-    to_remove = [key for key in pops if pops[key] == 0]
-    for key in to_remove:
-        pops.pop(key, None)
-    return intersections, pops
+            return pops
+        
+        if idx is None:
+            bounds = layer_bounds(b_df)
+            idx = build_index(bounds) if index_dir is None else \
+                  cached_index(bounds, index_dir, 'blocks')
+        
+        keys = [key for key in county_intersections \
+                if intersections[key] is not None]
+        key_geoms = np.array([intersections[key] for key in keys], \
+                             dtype=object)
+        
+        # assign groups in one intersection all at once, and only descend
+        # to the blocks of groups split between intersections
+        if groups is not None:
+            code = block_county_code(county, g_df[county_str])
+            g_rows = np.asarray(group_rows.get(code, []), dtype='int64')
+            inside = whole_groups(key_geoms, g_df.geometry.values[g_rows], \
+                                  n_threads)
+            for g, k in zip(g_rows, inside):
+                if k >= 0:
+                    pops[keys[k]] = pops[keys[k]] + int(group_pops[g])
+            split = np.isin(block_groups[rows], g_rows[inside < 0])
+            rows = np.asarray(rows)[split]
+            cblocks_df = b_df.iloc[rows]
+        
+        # use rtree to filter out a whole bunch of cases, querying once per
+        # county-district intersection
+        candidates = [set(idx.intersection(intersections[key].bounds)) \
+                      for key in keys]
+        
+        # candidate (block, intersection) pairs, by position in the county's
+        # blocks and in keys, in the order they are added up
+        pair_block = []
+        pair_key = []
+        for b, i in enumerate(rows):
+            for k in range(len(keys)):
+                if i in candidates[k]:
+                    pair_block.append(b)
+                    pair_key.append(k)
+        pair_block = np.array(pair_block, dtype='int64')
+        pair_key = np.array(pair_key, dtype='int64')
+        
+        # get intersection of block group with county-district overlap, will
+        # be zero or entire block group most of the time
+        block_geoms = cblocks_df.geometry.values
+        intersect_areas = intersection_area(key_geoms[pair_key], \
+                                            block_geoms[pair_block], \
+                                            n_threads)
+        
+        # get block data once
+        block_areas = area(block_geoms, n_threads) if area_str is None \
+                      else cblocks_df[area_str].to_numpy()
+        block_pops = cblocks_df[pop_str].to_numpy()
+        
+        # if block group is split, assume population is uniform over area; a
+        # block found entirely in one intersection is not added to later
+        # ones
+        if backend != 'shapely':
+            from kernels import allocate_pairs
+            totals = allocate_pairs(pair_block, pair_key, intersect_areas, \
+                                    block_areas, block_pops, len(keys), \
+                                    backend)
+            for key, total in zip(keys, totals.tolist()):
+                pops[key] = pops[key] + total
+            return pops
+        used = set()
+        for b, k, intersect_area in zip(pair_block, pair_key, \
+                                        intersect_areas):
+            if b not in used:
+                proportion = float(intersect_area / block_areas[b])
+                # population to add
+                pop_to_add = int(block_pops[b]) * proportion
+                pops[keys[k]] = pops[keys[k]] + pop_to_add
+                # mark as used
+                if proportion > 0.99:
+                    used.add(b)
+        return pops
+    
+    return allocate
 
 def county_district_intersection_pops(c_df, d_df, b_df, \
                                       b_county_str='COUNTYFP10',\
                                       c_county_str='COUNTYFP10',\
-                                      pop_str='POP10'):
+                                      pop_str='POP10', area_str=None, \
+                                      index_dir=None, n_threads=1, \
+                                      groups=None, backend='shapely'):
     ''' Calculates population of each county-district intersection,
     based on appropriate GeoDataFrames and block group populations.
     
@@ -162,14 +275,89 @@ def county_district_intersection_pops(c_df, d_df, b_df, \
         c_county_str: name of county column in c_df
         pop_str: the name of the column in b_df that contains 
             population data (type: string)
+        area_str: the name of a column in b_df with precomputed block areas,
+            or None to compute areas as needed
+        index_dir: folder to store the county and block spatial indexes in,
+            so later runs reuse them, or None to build them in memory
+        n_threads: number of threads to intersect geometries in (see
+            parallel.py), None for one per core
+        groups: block groups as outputted by groups_from_blocks, to assign
+            whole block groups at once where possible, or None
+        backend: as in get_pops_of_intersections
             
     Output: dictionary whose keys are ordered pairs (county, district)
         and whose values are the populations within these intersections.
         County and district names are not preserved, indices are whole numbers.
     '''
     
-    intersections = get_county_district_intersections(c_df, d_df, c_county_str)
-    return get_pops_of_intersections(intersections, b_df, b_county_str, pop_str)
+    intersections = get_county_district_intersections(c_df, d_df, \
+                                                      c_county_str, index_dir, \
+                                                      n_threads)
+    return get_pops_of_intersections(intersections, b_df, b_county_str, \
+                                     pop_str, area_str, index_dir, n_threads, \
+                                     groups, backend)
+
+def county_district_pop_arrays(c_df, d_df, b_df, b_county_str='COUNTYFP10', \
+                               c_county_str='COUNTYFP10', pop_str='POP10', \
+                               area_str=None, index_dir=None, n_threads=1, \
+                               groups=None, areas=False, backend='shapely', \
+                               block_index=None):
+    ''' Calculates the same populations as county_district_intersection_pops
+    without keeping the intersection geometries.  The intersections of each
+    county are made, allocated to and thrown away before moving on to the
+    next county, so at most one county's intersections are held at once.
+
+    Arguments:
+        c_df, d_df, b_df, b_county_str, c_county_str, pop_str, area_str,
+            index_dir, n_threads, groups, backend: as in
+            county_district_intersection_pops
+        areas: whether to also return the area of each intersection
+        block_index: as in block_allocator, so that a state's block index is
+            built once for all of its plans
+
+    Output: dictionary of arrays with one element per county-district
+        intersection with population: county, district, population and, if
+        areas is True, area
+    '''
+    import numpy as np
+    import shapely as shp
+    from parallel import intersection
+    from spatial_index import layer_bounds, build_index
+
+    allocate = block_allocator(b_df, b_county_str, pop_str, area_str, \
+                               index_dir, n_threads, groups, backend, \
+                               block_index)
+
+    # districts change from plan to plan, so their index is not stored
+    idx = build_index(layer_bounds(d_df))
+    d_geoms = d_df.geometry.values
+
+    output = {'county': [], 'district': [], 'population': []}
+    if areas:
+        output['area'] = []
+    for county, county_geom in zip(c_df[c_county_str], c_df.geometry):
+        # intersections of this county, in the same order as in
+        # get_county_district_intersections
+        j = np.array(sorted(idx.intersection(county_geom.bounds)), \
+                     dtype='int64')
+        pieces = intersection(np.full(len(j), county_geom, dtype=object), \
+                              d_geoms[j], n_threads)
+        county_intersections = {(county, d_df.index[k]): piece for k, piece \
+                                in zip(j, pieces) if not piece.is_empty}
+        pops = allocate(county, county_intersections)
+
+        for key, pop in pops.items():
+            if pop != 0:
+                output['county'].append(key[0])
+                output['district'].append(key[1])
+                output['population'].append(pop)
+                if areas:
+                    output['area'].append(shp.area(county_intersections[key]))
+        del pieces, county_intersections
+
+    return {name: np.array(values, dtype='float64') if name in \
+            ('population', 'area') else np.array(values) \
+            for name, values in output.items()}
 
 def counties_from_blocks(b_df, county_str):
     ''' Generates county GeoDataFrame (geometries only) based on block group
@@ -181,17 +369,235 @@ def counties_from_blocks(b_df, county_str):
             
     Output: GeoDataFrame with geometries of all counties in the state
     '''
+    import pandas as pd
+    import geopandas as gpd
+    from shapely.ops import unary_union
+
     counties = list(set(b_df.loc[:, county_str]))
     geometries = []
     for county in counties:
         in_county = b_df.loc[b_df[county_str] == county]
-        geometries.append(cascaded_union(list(in_county.loc[:, 'geometry'])))
+        geometries.append(unary_union(list(in_county.loc[:, 'geometry'])))
     df = pd.DataFrame(counties)
     return gpd.GeoDataFrame(df, geometry=geometries)
 
+def groups_from_blocks(b_df, county_str='COUNTYFP10', pop_str='POP10', \
+                       geoid_str='GEOID10', level=12):
+    ''' Aggregates blocks into block groups or tracts, using the fact that
+    block GEOIDs start with the GEOID of their block group (12 digits) and
+    tract (11 digits).  The groups do not depend on the districts, so they
+    can be built once per state and used for every plan.
+    
+    Arguments:
+        b_df: GeoDataFrame of the blocks in a state
+        county_str: name of county column in b_df
+        pop_str: the name of the population column in b_df
+        geoid_str: name of block GEOID column in b_df
+        level: number of GEOID digits to group by, 12 for block groups or
+            11 for tracts
+            
+    Output: GeoDataFrame of the groups, with the county, total population
+        and merged geometry of each, and an array of the position in it of
+        each block's group
+    '''
+    import numpy as np
+    import geopandas as gpd
+    import shapely as shp
+
+    codes = b_df[geoid_str].str[:level].to_numpy()
+    names, block_groups = np.unique(codes, return_inverse=True)
+    
+    # merge the blocks of each group, sorting them by group first
+    order = np.argsort(block_groups, kind='stable')
+    starts = np.searchsorted(block_groups[order], np.arange(len(names)))
+    geoms = b_df.geometry.values[order]
+    ends = np.append(starts[1:], len(order))
+    geometries = [shp.union_all(geoms[start:end]) \
+                  for start, end in zip(starts, ends)]
+    
+    pops = np.bincount(block_groups, weights=b_df[pop_str].to_numpy(), \
+                       minlength=len(names))
+    g_df = gpd.GeoDataFrame({county_str: b_df[county_str].iloc[order[starts]] \
+                                         .to_numpy(), \
+                             pop_str: pops.astype('int64')}, \
+                            index=names, geometry=geometries, crs=b_df.crs)
+    g_df[county_str] = g_df[county_str].astype(b_df[county_str].dtype)
+    return g_df, block_groups
+
+def whole_groups(key_geoms, group_geoms, n_threads=1, tolerance=1e-6):
+    # position in key_geoms of the geometry each group lies entirely in, or
+    # -1 if it is split between them
+    import numpy as np
+    import shapely as shp
+    from parallel import intersection_area
+
+    inside = np.full(len(group_geoms), -1, dtype='int64')
+    if len(key_geoms) == 0 or len(group_geoms) == 0:
+        return inside
+    
+    # candidate pairs whose bounds intersect
+    key_bounds = shp.bounds(key_geoms)
+    group_bounds = shp.bounds(group_geoms)
+    g, k = np.nonzero((group_bounds[:, None, 0] <= key_bounds[None, :, 2]) & \
+                      (group_bounds[:, None, 2] >= key_bounds[None, :, 0]) & \
+                      (group_bounds[:, None, 1] <= key_bounds[None, :, 3]) & \
+                      (group_bounds[:, None, 3] >= key_bounds[None, :, 1]))
+    areas = intersection_area(key_geoms[k], group_geoms[g], n_threads)
+    whole = areas >= (1 - tolerance) * shp.area(group_geoms)[g]
+    inside[g[whole]] = k[whole]
+    return inside
+
+def block_group_district_weights(bg_df, d_df, bg_id_str=None, \
+                                 d_id_str=None, output_file=None, \
+                                 batch_size=100000, n_threads=1):
+    ''' Calculates the fraction of the area of each block group that lies in
+    each district, replacing assign_block_groups_to_districts.  Candidate
+    pairs come from one bulk query of the district spatial index, and the
+    intersection areas are computed in vectorized batches.
+    
+    Arguments:
+        bg_df: GeoDataFrame of the block groups in a state
+        d_df: GeoDataFrame of the districts in a state
+        bg_id_str: name of block group id column in bg_df, or None to use 
+            the index
+        d_id_str: name of district id column in d_df, or None to use the
+            index
+        output_file: path of parquet file to write the weights to, or None
+        batch_size: number of block group-district pairs to intersect at once
+        n_threads: number of threads to intersect each batch in (see
+            parallel.py), None for one per core
+            
+    Output: DataFrame with columns BLOCK_GROUP, DISTRICT and WEIGHT, with
+        one row for each block group-district pair that overlaps
+    '''
+    import numpy as np
+    import pandas as pd
+    import shapely as shp
+    from parallel import intersection_area
+
+    bg_geoms = bg_df.geometry.values
+    d_geoms = d_df.geometry.values
+    
+    # find all pairs with intersecting bounds in one query
+    bg_i, d_i = d_df.sindex.query(bg_geoms, predicate='intersects')
+    
+    # get intersection areas in batches to bound memory
+    areas = []
+    for start in range(0, len(bg_i), batch_size):
+        stop = start + batch_size
+        areas.append(intersection_area(bg_geoms[bg_i[start:stop]], \
+                                       d_geoms[d_i[start:stop]], n_threads))
+    areas = np.concatenate(areas) if areas else np.zeros(0)
+    
+    bg_ids = bg_df.index if bg_id_str is None else bg_df[bg_id_str]
+    d_ids = d_df.index if d_id_str is None else d_df[d_id_str]
+    weights = pd.DataFrame({'BLOCK_GROUP': np.asarray(bg_ids)[bg_i], \
+                            'DISTRICT': np.asarray(d_ids)[d_i], \
+                            'WEIGHT': areas / shp.area(bg_geoms)[bg_i]})
+    weights = weights.loc[weights['WEIGHT'] > 0].reset_index(drop=True)
+    
+    if output_file is not None:
+        weights.to_parquet(output_file, index=False)
+    return weights
+
+def memory_usage(df):
+    ''' Calculates the memory used by a DataFrame, including the contents
+    of object columns.
+    
+    Arguments:
+        df: DataFrame or GeoDataFrame
+            
+    Output: memory usage in megabytes
+    '''
+    return df.memory_usage(deep=True).sum() / 2**20
+
+def block_county_code(county, county_col):
+    ''' Converts a county code (as found in the county GeoDataFrame) to the
+    type used in a block county column, so that lean block frames whose
+    county codes are integers can be matched against string county codes.
+    
+    Arguments:
+        county: county code, e.g. '001'
+        county_col: county column of the block GeoDataFrame
+            
+    Output: county code comparable with the values of county_col
+    '''
+    import pandas as pd
+
+    dtype = county_col.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    if pd.api.types.is_integer_dtype(dtype):
+        return int(county)
+    return county
+
+def shrink_blocks(b_df, county_str='COUNTYFP10', pop_str='POP10', \
+                  columns=None, verbose=True):
+    ''' Reduces the memory footprint of a block GeoDataFrame.  Keeps only the
+    columns needed for the population calculations, converts county codes to
+    small integer categoricals and downcasts populations to int32.
+    
+    Arguments:
+        b_df: GeoDataFrame of the blocks in a state
+        county_str: name of county column in b_df
+        pop_str: the name of the population column in b_df
+        columns: list of any other columns of b_df to keep
+        verbose: whether to print memory usage before and after
+            
+    Output: lean copy of b_df
+    '''
+    import pandas as pd
+
+    keep = [county_str, pop_str] + list(columns or []) + ['geometry']
+    before = memory_usage(b_df)
+    
+    # drop unneeded attribute columns
+    df = b_df.loc[:, [col for col in b_df.columns if col in keep]]
+    
+    # county codes are three digits, so they fit in an int16
+    codes = pd.to_numeric(df[county_str].to_numpy()).astype('int16')
+    df[county_str] = pd.Categorical(codes)
+    
+    # block populations are well below 2**31
+    df[pop_str] = df[pop_str].astype('int32')
+    
+    if verbose:
+        print(f'blocks: {before:.1f} MB -> {memory_usage(df):.1f} MB')
+    return df
+
+def read_blocks(file, county_str='COUNTYFP10', pop_str='POP10', \
+                columns=None, verbose=True):
+    ''' Reads a block shapefile, skipping unneeded attribute columns at
+    read time, and shrinks the result with shrink_blocks.
+    
+    Arguments:
+        file: path to block shapefile
+        county_str: name of county column in the shapefile
+        pop_str: the name of the population column in the shapefile
+        columns: list of any other columns to keep
+        verbose: whether to print the number of columns in the file and
+            read, and the memory usage of what was read before and after
+            shrinking it (the columns skipped are never loaded, so their
+            memory is not measured)
+            
+    Output: lean GeoDataFrame of the blocks in the file
+    '''
+    import geopandas as gpd
+    import pyogrio
+
+    keep = [county_str, pop_str] + list(columns or [])
+    if verbose:
+        n_fields = len(pyogrio.read_info(file)['fields'])
+        print(f'blocks: read {len(keep)} of {n_fields} attribute columns')
+    b_df = gpd.read_file(file, columns=keep)
+    return shrink_blocks(b_df, county_str, pop_str, columns, verbose)
+
 def left_position(geom):
     return geom.bounds[0]
-def same_plan(d_df1, d_df2, precision=0.01):
+def same_plan(d_df1, d_df2, precision=0.01, n_threads=1):
+    import numpy as np
+    from parallel import area, intersection_area
+
     try:
         geos1 = d_df1.loc[:, 'geometry']
         geos2 = d_df2.loc[:, 'geometry']
@@ -202,45 +608,13 @@ def same_plan(d_df1, d_df2, precision=0.01):
             return True
         if len(geos1) != len(geos2):
             return False
-        intersections = [geos1[i].intersection(geos2[i]).area \
-                         for i in range(len(geos1))]
-        intersections1 = [intersections[i]/geos1[i].area \
-                         for i in range(len(geos1))]
-        intersections2 = [intersections[i]/geos2[i].area \
-                         for i in range(len(geos1))]
-        for i in intersections1:
-            if i < 1 - precision or i > 1 + precision:
-                return False
-        for i in intersections2:
-            if i < 1 - precision or i > 1 + precision:
-                return False
-        return True
-    except:
+        # intersect all pairs of districts at once, in n_threads threads
+        intersections = intersection_area(geos1, geos2, n_threads, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intersections1 = intersections / area(geos1, n_threads, 1)
+            intersections2 = intersections / area(geos2, n_threads, 1)
+        # districts with no area give nan or inf, which are never close to 1
+        return bool(np.all(np.abs(intersections1 - 1) <= precision) and \
+                    np.all(np.abs(intersections2 - 1) <= precision))
+    except Exception:
         return False
-        
-# to save as json
-def dict_to_json(pops, output_file):
-    # make keys strings
-    output_pops = {}
-    for key in pops:
-        output_pops[f'C{key[0]}D{key[1]}'] = pops[key]
-    # write json
-    with open(output_file, 'w') as fp:
-        json.dump(output_pops, fp)
-        
-def json_to_dict(input_file):
-    # read json
-    with open(input_file, 'r') as fp:
-        string_key_dict = json.load(fp)
-    # make keys ordered pairs
-    output_dict = {}
-    for key in string_key_dict:
-        D = key.index('D')
-        output_dict[(key[1:D], key[D+1:])] = string_key_dict[key]
-    return output_dict
-        
-    
-        
-
-
-    
\ No newline at end of file
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels for allocating block populations: the area-weighted
+allocation of split blocks to county-district intersections done by
+block_allocator in geoprocessing.py, point-in-polygon classification of
+block centroids, and weighted scatter-add, working on packed arrays rather
+than shapely objects.  They need numba; without it, the backend switch
+falls back to the shapely path, which is faster than any pure numpy
+version.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def pack_polygons(geoms):
+    ''' Packs the edges of (multi)polygons into flat arrays
+
+    Arguments:
+        geoms: array of shapely polygons or multipolygons
+
+    Output: dictionary of
+        edges: (edges, 4) array of x1, y1, x2, y2 of every ring edge
+        edge_offsets: the edges of geometry i are
+            edges[edge_offsets[i]:edge_offsets[i+1]]
+        bounds: (geometries, 4) array of minx, miny, maxx, maxy
+    '''
+    import shapely as shp
+
+    geoms = np.asarray(geoms, dtype=object)
+    parts, part_geom = shp.get_parts(geoms, return_index=True)
+    rings, ring_part = shp.get_rings(parts, return_index=True)
+    coords, coord_ring = shp.get_coordinates(rings, return_index=True)
+
+    # consecutive coordinates of the same ring make an edge
+    same_ring = coord_ring[:-1] == coord_ring[1:]
+    edges = np.column_stack([coords[:-1][same_ring], coords[1:][same_ring]])
+    edge_geom = part_geom[ring_part[coord_ring[:-1][same_ring]]]
+    counts = np.bincount(edge_geom, minlength=len(geoms))
+    return {'edges': np.ascontiguousarray(edges, dtype='float64'), \
+            'edge_offsets': np.concatenate([[0], np.cumsum(counts)]), \
+            'bounds': shp.bounds(geoms)}
+
+def numpy_scatter_add(labels, weights, n):
+    found = labels >= 0
+    return np.bincount(labels[found], weights=weights[found], minlength=n)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def numba_assign_points(xs, ys, edges, edge_offsets, bounds):
+        labels = np.full(len(xs), -1, dtype=np.int64)
+        for p in numba.prange(len(xs)):
+            x = xs[p]
+            y = ys[p]
+            for g in range(len(bounds)):
+                if x < bounds[g, 0] or x > bounds[g, 2] or \
+                   y < bounds[g, 1] or y > bounds[g, 3]:
+                    continue
+                inside = False
+                for e in range(edge_offsets[g], edge_offsets[g+1]):
+                    x1 = edges[e, 0]
+                    y1 = edges[e, 1]
+                    x2 = edges[e, 2]
+                    y2 = edges[e, 3]
+                    if (y1 > y) != (y2 > y):
+                        if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                            inside = not inside
+                if inside:
+                    labels[p] = g
+                    break
+        return labels
+
+    @numba.njit(cache=True)
+    def numba_allocate_pairs(pair_block, pair_key, intersect_areas, \
+                             block_areas, block_pops, n_keys):
+        totals = np.zeros(n_keys)
+        used = np.zeros(len(block_areas), dtype=np.bool_)
+        for p in range(len(pair_block)):
+            b = pair_block[p]
+            if not used[b]:
+                proportion = intersect_areas[p] / block_areas[b]
+                totals[pair_key[p]] += block_pops[b] * proportion
+                if proportion > 0.99:
+                    used[b] = True
+        return totals
+
+    @numba.njit(cache=True)
+    def numba_scatter_add(labels, weights, n):
+        totals = np.zeros(n)
+        for i in range(len(labels)):
+            if labels[i] >= 0:
+                totals[labels[i]] += weights[i]
+        return totals
+
+def use_numba(backend):
+    # whether to run the numba kernels for a backend of 'auto', 'numba' or
+    # 'shapely'
+    if backend not in ('auto', 'numba', 'shapely'):
+        raise ValueError(f'unknown backend {backend}')
+    if backend == 'numba' and numba is None:
+        raise ImportError('numba is not installed')
+    return backend == 'numba' or (backend == 'auto' and numba is not None)
+
+def shapely_allocate_pairs(pair_block, pair_key, intersect_areas, \
+                           block_areas, block_pops, n_keys):
+    # the same loop in Python, in the same order
+    totals = np.zeros(n_keys)
+    used = set()
+    for b, k, intersect_area in zip(pair_block.tolist(), pair_key.tolist(), \
+                                    intersect_areas.tolist()):
+        if b not in used:
+            proportion = intersect_area / block_areas[b]
+            totals[k] += block_pops[b] * proportion
+            if proportion > 0.99:
+                used.add(b)
+    return totals
+
+def allocate_pairs(pair_block, pair_key, intersect_areas, block_areas, \
+                   block_pops, n_keys, backend='auto'):
+    ''' Allocates the population of blocks to intersections in proportion to
+    the share of each block's area in each, going through candidate pairs in
+    order.  A block found (more than 99%) in one intersection is not added
+    to later ones, as in get_pops_of_intersections.
+
+    Arguments:
+        pair_block: array of the block of each candidate pair, by position
+            in block_areas and block_pops
+        pair_key: array of the intersection of each candidate pair, from 0
+            to n_keys-1
+        intersect_areas: array of the area of the block within the
+            intersection, for each pair
+        block_areas: array of block areas
+        block_pops: array of block populations
+        n_keys: number of intersections
+        backend: 'numba', 'shapely', or 'auto' to use numba if installed
+
+    Output: array of the population of each intersection
+    '''
+    kernel = numba_allocate_pairs if use_numba(backend) else \
+             shapely_allocate_pairs
+    return kernel(np.ascontiguousarray(pair_block, dtype='int64'), \
+                  np.ascontiguousarray(pair_key, dtype='int64'), \
+                  np.ascontiguousarray(intersect_areas, dtype='float64'), \
+                  np.ascontiguousarray(block_areas, dtype='float64'), \
+                  np.ascontiguousarray(block_pops, dtype='float64'), n_keys)
+
+def shapely_assign_points(xs, ys, geoms):
+    # shapely's spatial index and predicates; the first polygon containing a
+    # point wins, as in the numba kernel
+    import shapely as shp
+
+    point_i, geom_i = shp.STRtree(geoms).query(shp.points(xs, ys), \
+                                               predicate='within')
+    order = np.lexsort((geom_i, point_i))
+    labels = np.full(len(xs), -1, dtype='int64')
+    labels[point_i[order][::-1]] = geom_i[order][::-1]
+    return labels
+
+def assign_points(xs, ys, geoms, backend='auto'):
+    ''' Finds the polygon containing each point
+
+    Arguments:
+        xs: array of x coordinates
+        ys: array of y coordinates
+        geoms: array of polygons, e.g. county-district intersections
+        backend: 'numba', 'shapely', or 'auto' to use numba if installed
+
+    Output: array with the position of the polygon containing each point,
+        or -1 for points outside every polygon
+    '''
+    xs = np.ascontiguousarray(xs, dtype='float64')
+    ys = np.ascontiguousarray(ys, dtype='float64')
+    geoms = np.asarray(geoms, dtype=object)
+    if not use_numba(backend):
+        return shapely_assign_points(xs, ys, geoms)
+    packed = pack_polygons(geoms)
+    return numba_assign_points(xs, ys, packed['edges'], \
+                               packed['edge_offsets'], packed['bounds'])
+
+def scatter_add(labels, weights, n, backend='auto'):
+    ''' Sums weights by label
+
+    Arguments:
+        labels: array of labels from 0 to n-1, or -1 to leave out
+        weights: array of weights
+        n: number of labels
+        backend: 'numba', 'shapely', or 'auto' to use numba if installed;
+            without numba, numpy's bincount is used
+
+    Output: array of n sums
+    '''
+    labels = np.ascontiguousarray(labels, dtype='int64')
+    weights = np.ascontiguousarray(weights, dtype='float64')
+    kernel = numba_scatter_add if use_numba(backend) else numpy_scatter_add
+    return kernel(labels, weights, n)
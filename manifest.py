@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite manifest of the (state, body, plan) units of a batch run, so that
+runs can be resumed where they stopped and failed units retried.
+
+A running unit is leased to the job running it (host and process id),
+which renews the lease from a background thread while it works.  Jobs
+sharing a manifest only put back in the queue units whose lease has run out
+or whose owner is known to be gone, never units another job is working on.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+STATUSES = ['pending', 'running', 'done', 'failed']
+
+# seconds without a renewal after which a running unit's job is presumed
+# dead, and seconds between renewals
+LEASE_SECONDS = 600
+HEARTBEAT_SECONDS = 60
+
+def owner_name():
+    # name of this job, as recorded against the units it runs
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def owner_gone(owner):
+    # whether owner is a process on this host that no longer exists
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def open_manifest(file):
+    ''' Opens (creating if needed) a manifest database
+
+    Arguments:
+        file: path to the SQLite file
+
+    Output: sqlite3 connection
+    '''
+    conn = sqlite3.connect(file, timeout=60, isolation_level=None)
+    conn.execute('''CREATE TABLE IF NOT EXISTS units (
+                        state TEXT NOT NULL,
+                        body TEXT NOT NULL,
+                        plan TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        started REAL,
+                        finished REAL,
+                        seconds REAL,
+                        error TEXT,
+                        owner TEXT,
+                        heartbeat REAL,
+                        PRIMARY KEY (state, body, plan))''')
+    # manifests made before units were leased
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(units)')]
+    for column, kind in [('owner', 'TEXT'), ('heartbeat', 'REAL')]:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE units ADD COLUMN {column} {kind}')
+    return conn
+
+def add_units(conn, units):
+    ''' Adds units to the manifest, leaving units already in it untouched
+
+    Arguments:
+        conn: as outputted by open_manifest
+        units: list of (state, body, plan) tuples
+    '''
+    conn.executemany('INSERT OR IGNORE INTO units (state, body, plan) ' \
+                     'VALUES (?, ?, ?)', units)
+
+def resume(conn, state=None, body=None, retry_failed=True, \
+           lease=LEASE_SECONDS):
+    ''' Puts units whose job was killed, and optionally failed units, back
+    in the queue.  A running unit is only put back once its lease has run
+    out, or at once if its job was on this host and no longer exists, so
+    units that other jobs are working on are left alone.  Finished units
+    are not rerun.
+
+    Arguments:
+        conn: as outputted by open_manifest
+        state: only resume units of this state, or None for any state
+        body: only resume units of this body, or None for any body
+        retry_failed: whether to also retry units that failed
+        lease: seconds without a renewal after which a running unit's job
+            is presumed dead
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        running = conn.execute('''SELECT state, body, plan, owner, heartbeat
+                                  FROM units WHERE status = 'running'
+                                  AND (? IS NULL OR state = ?)
+                                  AND (? IS NULL OR body = ?)''', \
+                               (state, state, body, body)).fetchall()
+        expired = time.time() - lease
+        stale = [unit for *unit, owner, heartbeat in running \
+                 if heartbeat is None or heartbeat < expired or \
+                 owner_gone(owner)]
+        if retry_failed:
+            stale += conn.execute('''SELECT state, body, plan FROM units
+                                     WHERE status = 'failed'
+                                     AND (? IS NULL OR state = ?)
+                                     AND (? IS NULL OR body = ?)''', \
+                                  (state, state, body, body)).fetchall()
+        conn.executemany('''UPDATE units SET status = 'pending',
+                             owner = NULL, heartbeat = NULL
+                             WHERE state = ? AND body = ? AND plan = ?''', \
+                         [tuple(unit) for unit in stale])
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+def pending_units(conn, state=None, body=None):
+    ''' Lists the pending units, in the order they were added
+
+    Arguments:
+        conn: as outputted by open_manifest
+        state: only list units of this state, or None for any state
+        body: only list units of this body, or None for any body
+
+    Output: list of (state, body, plan) tuples
+    '''
+    return conn.execute('''SELECT state, body, plan FROM units
+                           WHERE status = 'pending'
+                           AND (? IS NULL OR state = ?)
+                           AND (? IS NULL OR body = ?)
+                           ORDER BY rowid''', \
+                        (state, state, body, body)).fetchall()
+
+def start_unit(conn, unit, owner=None):
+    ''' Marks a unit as running and leases it to a job, for schedulers that
+    pick units themselves rather than claiming them with claim_unit
+
+    Arguments:
+        conn: as outputted by open_manifest
+        unit: (state, body, plan) tuple
+        owner: name of the job running the unit, as renewed by Heartbeat
+            (defaults to this process)
+    '''
+    now = time.time()
+    conn.execute('''UPDATE units SET status = 'running',
+                    attempts = attempts + 1, started = ?,
+                    finished = NULL, seconds = NULL, error = NULL,
+                    owner = ?, heartbeat = ?
+                    WHERE state = ? AND body = ? AND plan = ?''', \
+                 (now, owner or owner_name(), now, *unit))
+
+def claim_unit(conn, state=None, body=None):
+    ''' Marks the next pending unit as running.  Safe to call from several
+    processes sharing the same manifest.
+
+    Arguments:
+        conn: as outputted by open_manifest
+        state: only claim units of this state, or None for any state
+        body: only claim units of this body, or None for any body
+
+    Output: (state, body, plan) tuple, or None if there are no pending units
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        unit = conn.execute('''SELECT state, body, plan FROM units
+                               WHERE status = 'pending'
+                               AND (? IS NULL OR state = ?)
+                               AND (? IS NULL OR body = ?)
+                               ORDER BY rowid LIMIT 1''', \
+                            (state, state, body, body)).fetchone()
+        if unit is not None:
+            start_unit(conn, unit)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return unit
+
+def finish_unit(conn, unit, error=None):
+    ''' Records that a unit is done, or that it failed
+
+    Arguments:
+        conn: as outputted by open_manifest
+        unit: (state, body, plan) tuple
+        error: error message if the unit failed, otherwise None
+    '''
+    status = 'done' if error is None else 'failed'
+    now = time.time()
+    conn.execute('''UPDATE units SET status = ?, finished = ?,
+                    seconds = ? - started, error = ?, heartbeat = NULL
+                    WHERE state = ? AND body = ? AND plan = ?''', \
+                 (status, now, now, error, *unit))
+
+class Heartbeat:
+    ''' Renews the leases of the units a job is running, from a background
+    thread with its own connection.  Use as a context manager around the
+    work.
+
+    Arguments:
+        conn: as outputted by open_manifest
+        owner: name of the job (defaults to this process)
+        interval: seconds between renewals
+    '''
+    def __init__(self, conn, owner=None, interval=HEARTBEAT_SECONDS):
+        # the file conn is open on, for the thread's own connection
+        self.file = conn.execute('PRAGMA database_list').fetchone()[2]
+        self.owner = owner or owner_name()
+        self.interval = interval
+        self.stop = threading.Event()
+        self.thread = None
+
+    def renew(self, conn):
+        conn.execute('''UPDATE units SET heartbeat = ?
+                        WHERE status = 'running' AND owner = ?''', \
+                     (time.time(), self.owner))
+
+    def loop(self):
+        conn = open_manifest(self.file)
+        try:
+            while not self.stop.wait(self.interval):
+                self.renew(conn)
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+
+def summary(conn):
+    ''' Counts the units with each status
+
+    Arguments:
+        conn: as outputted by open_manifest
+
+    Output: dictionary whose keys are statuses and values are counts
+    '''
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM units ' \
+                               'GROUP BY status').fetchall())
+    return {status: counts.get(status, 0) for status in STATUSES}
+
+def run_units(conn, work, state=None, body=None):
+    ''' Runs pending units one at a time until none are left.  A failure is
+    recorded against its unit and does not stop the remaining units.
+
+    Arguments:
+        conn: as outputted by open_manifest
+        work: function called with (state, body, plan) for each unit
+        state: only run units of this state, or None for any state
+        body: only run units of this body, or None for any body
+
+    Output: list of units that failed
+    '''
+    failed = []
+    with Heartbeat(conn):
+        while True:
+            unit = claim_unit(conn, state, body)
+            if unit is None:
+                return failed
+            try:
+                work(*unit)
+            except Exception:
+                finish_unit(conn, unit, traceback.format_exc())
+                failed.append(unit)
+            else:
+                finish_unit(conn, unit)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Per-county breakdowns of the metrics, and county geometries to map them on.
+"""
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from metrics import group_pops
+from preprocess import atomic_path
+
+def county_contributions(pops):
+    ''' Breaks each metric down by county
+
+    Arguments:
+        pops: dictionary whose keys are ordered pairs (county, district)
+            and whose values are the populations within these intersections.
+
+    Output: DataFrame indexed by county code, with columns
+        counties_split: 1 if the county is split, otherwise 0
+        county_intersections: number of districts the county is in
+        preserved_pairs: the county's pairs in the same district, over the
+            state's pairs in the same county (sums to preserved_pairs)
+        preserved_pairs_within: probability that two randomly chosen people
+            from the county are in the same district
+        largest_intersection: the county's largest intersection, over the
+            state's population (sums to largest_intersection)
+        entropy: the county's share of the conditional entropy that
+            min_entropy is calculated from (sums to that entropy)
+    '''
+    counties, _, county_ids, _, values = group_pops(pops)
+    county_pops = np.bincount(county_ids, weights=values)
+    intersections = np.bincount(county_ids)
+    maxes = np.zeros(len(counties))
+    np.maximum.at(maxes, county_ids, values)
+    total = values.sum()
+
+    good_pairs = np.bincount(county_ids, weights=values * (values-1) / 2)
+    all_pairs = county_pops * (county_pops-1) / 2
+    entropies = np.bincount(county_ids, weights=values * \
+                            np.log2(values / county_pops[county_ids]))
+
+    return pd.DataFrame({'counties_split': (intersections > 1).astype(int), \
+                         'county_intersections': intersections, \
+                         'preserved_pairs': good_pairs / all_pairs.sum(), \
+                         'preserved_pairs_within': good_pairs / all_pairs, \
+                         'largest_intersection': maxes / total, \
+                         'entropy': (-1) * entropies / total}, \
+                        index=pd.Index(counties, name='county'))
+
+# simplified county layers already read in, by file and tolerance
+county_layers = {}
+
+def simplified_counties(county_file, tolerance, cache_dir=None):
+    ''' Reads a county shapefile with simplified geometries, for quick
+    choropleths.  Simplified layers are kept in memory and, if cache_dir is
+    given, on disk, so each is only simplified once.
+
+    Arguments:
+        county_file: path to county shapefile
+        tolerance: maximum distance geometries can move, in the units of
+            the shapefile's CRS
+        cache_dir: folder of cached simplified layers, or None
+
+    Output: GeoDataFrame of the counties with simplified geometries
+    '''
+    # key on the file's size and modification time, so edits are picked up
+    stat = os.stat(county_file)
+    key = (os.path.abspath(county_file), stat.st_size, stat.st_mtime_ns, \
+           tolerance)
+    if key in county_layers:
+        return county_layers[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        name = os.path.basename(county_file)[:-4] + f'_{digest}.parquet'
+        cache_file = os.path.join(cache_dir, name)
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        geo_df = gpd.read_parquet(cache_file)
+    else:
+        geo_df = gpd.read_file(county_file)
+        # preserving topology keeps each county a valid polygon, but counties
+        # are simplified one at a time, so shared borders can drift apart
+        # by up to the tolerance, leaving slivers too small to see on a map
+        geo_df['geometry'] = geo_df.geometry.simplify(tolerance, \
+                                                      preserve_topology=True)
+        if cache_file is not None:
+            with atomic_path(cache_file) as temp_file:
+                geo_df.to_parquet(temp_file)
+
+    county_layers[key] = geo_df
+    return geo_df
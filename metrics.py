@@ -21,7 +21,23 @@ def threshold(pops, threshold=50):
     for key in keys_to_remove:
         pops.pop(key, None)
     return pops
-        
+
+def plan_threshold(pops, fraction=0.005, cap=500):
+    ''' Threshold used for a plan in our analysis: a fraction of the
+    average district population, capped.
+
+    Arguments:
+        pops: dictionary whose keys are ordered pairs (county, district)
+            and whose values are the populations within these intersections.
+        fraction: fraction of the average district population
+        cap: largest threshold to use
+
+    Output:
+        threshold for pops
+    '''
+    num_districts = len(set([key[1] for key in pops]))
+    return min(fraction * sum(pops.values()) / num_districts, cap)
+
 def counties_split(pops):
     counties = set([key[0] for key in pops])
     
@@ -120,3 +136,192 @@ def min_entropy(pops):
     # calcuate conditional entropy, return reciprocal
     c_entropy = (-1) * sum(county_entropies) / sum(pops.values())
     return 1/(1+c_entropy)
+
+    
+def threshold_sweep(pops, thresholds):
+    ''' Calculates every metric at each of a list of thresholds, without
+    modifying or copying pops.  The intersection populations are sorted
+    once, and each metric at each threshold is read off cumulative sums
+    over that order.
+    
+    Arguments: 
+        pops: dictionary whose keys are ordered pairs (county, district)
+        and whose values are the populations within these intersections.
+        thresholds: list of thresholds, as in threshold
+            
+    Output: 
+        dictionary whose keys are metric names (counties_split, 
+        county_intersections, preserved_pairs, largest_intersection, 
+        min_entropy) and whose values are arrays of the metric at each
+        threshold, equal to the metric of threshold(pops, t) for each t'''
+        
+    thresholds = np.asarray(thresholds, dtype='float64')
+    
+    # sort intersections in the order thresholding removes them
+    _, county_ids = np.unique([key[0] for key in pops], return_inverse=True)
+    values = np.fromiter(pops.values(), dtype='float64', count=len(pops))
+    order = np.argsort(values, kind='stable')
+    v = values[order]
+    c = county_ids[order]
+    n = len(v)
+    
+    # number of intersections removed at each threshold
+    removed = np.searchsorted(v, thresholds, side='left')
+    
+    def prefix(x):
+        # prefix[k] is the sum of the first k elements
+        return np.concatenate([[0], np.cumsum(x)])
+    
+    def xlogx(x):
+        return np.where(x > 0, x * np.log2(np.where(x > 0, x, 1)), 0)
+    
+    # group intersections by county, keeping the removal order in each
+    by_county = np.argsort(c, kind='stable')
+    grouped = v[by_county]
+    starts = np.flatnonzero(np.diff(c[by_county], prepend=-1))
+    ends = np.append(starts[1:], n) - 1
+    sizes = ends - starts + 1
+    
+    # county populations before each intersection is removed
+    cum = np.cumsum(grouped)
+    group_base = np.repeat(cum[starts] - grouped[starts], sizes)
+    before_in_county = cum - grouped - group_base
+    removed_before = np.empty(n)
+    removed_before[by_county] = before_in_county
+    county_pops = np.bincount(c, weights=v)
+    pop_before = county_pops[c] - removed_before
+    pop_after = pop_before - v
+    
+    # total population, and sums over counties of pop^2 and pop*log(pop)
+    total = v.sum() - prefix(v)[removed]
+    squares = (county_pops**2).sum() + prefix(pop_after**2 - pop_before**2)
+    county_xlogx = xlogx(county_pops).sum() + \
+                   prefix(xlogx(pop_after) - xlogx(pop_before))
+    
+    # counties stay split while their second largest intersection is kept
+    second = np.sort(grouped[ends - 1][sizes > 1])
+    
+    # each county's largest intersection is the last one removed
+    largest = np.sort(grouped[ends])
+    largest_kept = largest.sum() - \
+                   prefix(largest)[np.searchsorted(largest, thresholds)]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        same_district = (v * (v-1) / 2).sum() - prefix(v * (v-1) / 2)[removed]
+        same_county = (squares[removed] - total) / 2
+        c_entropy = -((xlogx(v).sum() - prefix(xlogx(v))[removed]) - \
+                      county_xlogx[removed]) / total
+        # ratios are undefined once every intersection is removed
+        empty = np.where(removed == n, np.nan, 1)
+        return {'counties_split': len(second) - \
+                                  np.searchsorted(second, thresholds), \
+                'county_intersections': n - removed, \
+                'preserved_pairs': empty * same_district / same_county, \
+                'largest_intersection': empty * largest_kept / total, \
+                'min_entropy': empty / (1 + c_entropy)}
+
+def sweep_plans(plans, thresholds):
+    ''' Calculates every metric for each plan at each threshold
+    
+    Arguments: 
+        plans: list of pops dictionaries
+        thresholds: list of thresholds used for every plan, or a 2-d array
+            with one row of thresholds per plan
+            
+    Output: 
+        dictionary whose keys are metric names and whose values are 
+        arrays with one row per plan and one column per threshold'''
+    
+    thresholds = np.asarray(thresholds, dtype='float64')
+    if thresholds.ndim == 1:
+        thresholds = np.tile(thresholds, (len(plans), 1))
+    sweeps = [threshold_sweep(pops, t) for pops, t in zip(plans, thresholds)]
+    return {metric: np.array([sweep[metric] for sweep in sweeps]) \
+            for metric in sweeps[0]}
+
+def group_pops(pops):
+    ''' Converts pops to arrays, numbering counties and districts
+    
+    Arguments: 
+        pops: dictionary whose keys are ordered pairs (county, district)
+        and whose values are the populations within these intersections.
+            
+    Output: 
+        counties: sorted array of county names
+        districts: sorted array of district names
+        county_ids: position in counties of the county of each intersection
+        district_ids: position in districts of the district of each 
+            intersection
+        values: population of each intersection'''
+    
+    keys = list(pops)
+    counties, county_ids = np.unique([key[0] for key in keys], \
+                                     return_inverse=True)
+    districts, district_ids = np.unique([key[1] for key in keys], \
+                                        return_inverse=True)
+    values = np.fromiter(pops.values(), dtype='float64', count=len(keys))
+    return counties, districts, county_ids, district_ids, values
+
+def grouped_metrics(ids, values):
+    ''' Calculates counts of split groups, preserved pairs, largest 
+    intersection and min entropy, where the intersections are grouped by 
+    ids (county ids for the usual metrics, district ids for the mirror
+    image)
+    
+    Arguments: 
+        ids: group of each intersection, numbered from 0
+        values: population of each intersection
+            
+    Output: 
+        dictionary of split, preserved_pairs, largest_intersection and
+        min_entropy'''
+    
+    group_totals = np.bincount(ids, weights=values)
+    group_sizes = np.bincount(ids)
+    group_maxes = np.zeros(len(group_totals))
+    np.maximum.at(group_maxes, ids, values)
+    total = values.sum()
+    
+    # entropy of the other partition within each group
+    within = (values * np.log2(values / group_totals[ids])).sum()
+    c_entropy = (-1) * within / total
+    return {'split': int((group_sizes > 1).sum()), \
+            'preserved_pairs': (values * (values-1) / 2).sum() / \
+                               (group_totals * (group_totals-1) / 2).sum(), \
+            'largest_intersection': group_maxes.sum() / total, \
+            'min_entropy': 1 / (1 + c_entropy)}
+
+def split_metrics(pops):
+    ''' Calculates the county-side metrics (counties_split, 
+    county_intersections, preserved_pairs, largest_intersection, 
+    min_entropy) and their district-side mirror images in one pass over a 
+    grouped representation of pops.
+    
+    Arguments: 
+        pops: dictionary whose keys are ordered pairs (county, district)
+        and whose values are the populations within these intersections.
+            
+    Output: 
+        dictionary of the county-side metrics, as calculated by the 
+        functions above, and of the district-side metrics:
+            districts_split: number of districts spanning multiple counties
+            district_preserved_pairs: probability that two randomly chosen
+                people from the same district are also in the same county
+            district_largest_intersection: fraction of people who are in 
+                the county that has the largest number of their district's 
+                residents
+            district_min_entropy: min_entropy of the county partition with 
+                respect to the district partition'''
+    
+    _, _, county_ids, district_ids, values = group_pops(pops)
+    by_county = grouped_metrics(county_ids, values)
+    by_district = grouped_metrics(district_ids, values)
+    
+    output = {'counties_split': by_county['split'], \
+              'county_intersections': len(values)}
+    for metric in ['preserved_pairs', 'largest_intersection', 'min_entropy']:
+        output[metric] = by_county[metric]
+    output['districts_split'] = by_district['split']
+    for metric in ['preserved_pairs', 'largest_intersection', 'min_entropy']:
+        output['district_' + metric] = by_district[metric]
+    return output
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Populations of the intersections of any unit layer of a state (counties,
+places, VTDs or school districts) with district plans, through the state's
+blocks.  Every unit layer is handled the way geoprocessing handles counties:
+each unit is intersected with the districts, and the blocks of the unit are
+allocated to the pieces by block_allocator, so counties come out exactly as
+the pipeline writes them.  Census blocks nest in every census unit layer, so
+the unit of each block is taken from a block column when the blocks carry
+one, and otherwise from the unit containing a point on the block's surface.
+
+The block index, the units of the blocks and the district index of each
+plan are kept, so every unit layer is scored against every plan without
+redoing any of them.  The pops this produces are keyed by (unit, district),
+so the functions of metrics.py apply to any unit layer, with "county" read
+as "unit".
+"""
+
+class PartitionOverlap:
+    ''' Blocks of a state, and the unit layers and plans added to them
+
+    Arguments:
+        b_df: GeoDataFrame of the blocks in a state
+        pop_str: the name of the population column in b_df
+        area_str: the name of a column in b_df with precomputed block areas
+            (see preprocess.py), or None to compute them
+        index_dir: folder of stored spatial indexes (see spatial_index.py),
+            or None to build the block index in memory
+        n_threads: number of threads to intersect geometries in (see
+            parallel.py), None for one per core
+        backend: as in get_pops_of_intersections in geoprocessing.py
+        block_index: R-tree index of the rows of b_df to share, or None to
+            build one
+    '''
+    def __init__(self, b_df, pop_str='POP10', area_str=None, index_dir=None, \
+                 n_threads=1, backend='shapely', block_index=None):
+        from spatial_index import layer_bounds, build_index, cached_index
+
+        # the unit of each block in each layer is added as a column, without
+        # copying the blocks or changing the caller's frame
+        self.b_df = b_df.copy(deep=False)
+        self.pop_str = pop_str
+        self.area_str = area_str
+        self.n_threads = n_threads
+        self.backend = backend
+        self.index = block_index
+        if self.index is None:
+            bounds = layer_bounds(b_df)
+            self.index = build_index(bounds) if index_dir is None else \
+                         cached_index(bounds, index_dir, 'blocks')
+        # name -> dictionary of the geometries, names and allocator of a
+        # unit layer, or the geometries, names and index of a plan
+        self.units = {}
+        self.plans = {}
+
+    def add_units(self, name, u_df, id_str=None, block_str=None):
+        ''' Adds a unit layer
+
+        Arguments:
+            name: name of the layer (example: 'places')
+            u_df: GeoDataFrame of the units
+            id_str: name of the column of u_df naming the units, or None to
+                name them by the index of u_df
+            block_str: name of a column of the blocks holding the name of
+                the unit of each block (example: 'COUNTYFP10' for counties),
+                or None to find the unit of each block from its geometry
+        '''
+        import numpy as np
+        import shapely as shp
+        from geoprocessing import block_allocator, block_county_code
+        from kernels import assign_points
+
+        if name in self.units:
+            return
+        names = list(u_df.index if id_str is None else u_df[id_str])
+        if block_str is not None:
+            column = self.b_df[block_str]
+            positions = {block_county_code(unit, column): i for i, unit \
+                         in enumerate(names)}
+            block_units = column.map(positions).fillna(-1).to_numpy()
+        else:
+            points = shp.point_on_surface(self.b_df.geometry.values)
+            block_units = assign_points(shp.get_x(points), shp.get_y(points), \
+                                        u_df.geometry.values, self.backend)
+        unit_str = f'unit_{name}'
+        self.b_df[unit_str] = np.asarray(block_units, dtype='int64')
+        allocate = block_allocator(self.b_df, unit_str, self.pop_str, \
+                                   self.area_str, n_threads=self.n_threads, \
+                                   backend=self.backend, \
+                                   block_index=self.index)
+        self.units[name] = {'geoms': u_df.geometry.values, 'names': names, \
+                            'allocate': allocate}
+
+    def add_plan(self, name, d_df, id_str=None):
+        ''' Adds a district plan
+
+        Arguments:
+            name: name of the plan (example: '2018_congress')
+            d_df: GeoDataFrame of the districts
+            id_str: name of the column of d_df naming the districts, or None
+                to name them by the index of d_df, as geoprocessing does
+        '''
+        from spatial_index import layer_bounds, build_index
+
+        if name not in self.plans:
+            self.plans[name] = {'geoms': d_df.geometry.values, \
+                                'names': list(d_df.index if id_str is None \
+                                              else d_df[id_str]), \
+                                'index': build_index(layer_bounds(d_df))}
+
+    def drop_plan(self, name):
+        # forget a plan once every unit layer has been scored against it
+        self.plans.pop(name, None)
+
+    def pops(self, units, plan):
+        ''' Calculates the population of each unit-district intersection,
+        one unit at a time, as county_district_pop_arrays does for counties
+
+        Arguments:
+            units: name of a unit layer added with add_units
+            plan: name of a plan added with add_plan
+
+        Output: dictionary whose keys are ordered pairs (unit, district)
+            and whose values are the populations within these
+            intersections, as geoprocessing outputs for counties
+        '''
+        import numpy as np
+        from parallel import intersection
+
+        u = self.units[units]
+        p = self.plans[plan]
+        pops = {}
+        for i, unit_geom in enumerate(u['geoms']):
+            j = np.array(sorted(p['index'].intersection(unit_geom.bounds)), \
+                         dtype='int64')
+            pieces = intersection(np.full(len(j), unit_geom, dtype=object), \
+                                  p['geoms'][j], self.n_threads)
+            unit_intersections = {(i, k): piece for k, piece \
+                                  in zip(j.tolist(), pieces) \
+                                  if not piece.is_empty}
+            for (_, k), pop in u['allocate'](i, unit_intersections).items():
+                if pop != 0:
+                    pops[(u['names'][i], p['names'][k])] = pop
+        return pops
+
+    def metrics(self, units, plan):
+        ''' Calculates the split metrics of a unit layer against a plan
+
+        Arguments:
+            units: name of a unit layer added with add_units
+            plan: name of a plan added with add_plan
+
+        Output: as outputted by split_metrics in metrics.py, with counties
+            standing for units
+        '''
+        from metrics import split_metrics
+        return split_metrics(self.pops(units, plan))
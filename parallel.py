@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Runs vectorized shapely operations on chunks of geometry arrays in a pool
+of threads.  Shapely releases the GIL while GEOS works, so the threads use
+several cores at once while sharing the geometries already loaded in this
+process, with nothing pickled or copied between processes.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# fewest elements worth handing to a thread of the pool
+MIN_CHUNK = 16
+
+def default_threads():
+    # cores this process may run on
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def map_chunks(func, arrays, n_threads=None, chunk_size=10000):
+    ''' Applies a vectorized function to matching chunks of arrays in a
+    thread pool, and joins the results in order
+
+    Arguments:
+        func: function of len(arrays) arrays returning an array as long as
+            each of them
+        arrays: list of arrays of the same length
+        n_threads: number of threads, None for one per core, or 1 to run in
+            this thread
+        chunk_size: most elements per chunk; the arrays are split into at
+            least n_threads chunks of at least MIN_CHUNK elements
+
+    Output: array of func applied to all elements
+    '''
+    import numpy as np
+
+    n = len(arrays[0])
+    if n_threads is None:
+        n_threads = default_threads()
+    # smaller chunks than chunk_size if needed to keep every thread busy
+    chunk_size = max(min(chunk_size, -(-n // max(n_threads, 1))), MIN_CHUNK)
+    if n_threads <= 1 or n <= chunk_size:
+        return func(*arrays)
+
+    chunks = [[array[start:start+chunk_size] for array in arrays] \
+              for start in range(0, n, chunk_size)]
+    with ThreadPoolExecutor(n_threads) as pool:
+        results = list(pool.map(lambda chunk: func(*chunk), chunks))
+    return np.concatenate(results)
+
+def intersection(geoms1, geoms2, n_threads=None, chunk_size=10000):
+    ''' Intersects two arrays of geometries element by element
+
+    Arguments:
+        geoms1: array of shapely geometries
+        geoms2: array of shapely geometries as long as geoms1
+        n_threads: number of threads, None for one per core, or 1 to run in
+            this thread
+        chunk_size: number of pairs per chunk
+
+    Output: array of intersections
+    '''
+    import numpy as np
+    import shapely as shp
+
+    geoms1 = np.asarray(geoms1, dtype=object)
+    geoms2 = np.asarray(geoms2, dtype=object)
+    return map_chunks(shp.intersection, [geoms1, geoms2], n_threads, \
+                      chunk_size)
+
+def intersection_area(geoms1, geoms2, n_threads=None, chunk_size=10000):
+    ''' Finds the areas of the intersections of two arrays of geometries,
+    element by element, without keeping the intersections
+
+    Arguments:
+        geoms1: array of shapely geometries
+        geoms2: array of shapely geometries as long as geoms1
+        n_threads: number of threads, None for one per core, or 1 to run in
+            this thread
+        chunk_size: number of pairs per chunk
+
+    Output: array of areas
+    '''
+    import numpy as np
+    import shapely as shp
+
+    geoms1 = np.asarray(geoms1, dtype=object)
+    geoms2 = np.asarray(geoms2, dtype=object)
+    return map_chunks(lambda a, b: shp.area(shp.intersection(a, b)), \
+                      [geoms1, geoms2], n_threads, chunk_size)
+
+def area(geoms, n_threads=None, chunk_size=10000):
+    ''' Finds the areas of an array of geometries
+
+    Arguments:
+        geoms: array of shapely geometries
+        n_threads: number of threads, None for one per core, or 1 to run in
+            this thread
+        chunk_size: number of geometries per chunk
+
+    Output: array of areas
+    '''
+    import numpy as np
+    import shapely as shp
+
+    geoms = np.asarray(geoms, dtype=object)
+    return map_chunks(shp.area, [geoms], n_threads, chunk_size)
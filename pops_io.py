@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing pops dictionaries.  Only uses the standard library, so
+that scoring precomputed results does not load the GIS stack.
+"""
+import json
+
+# to save as json
+def dict_to_json(pops, output_file):
+    # make keys strings
+    output_pops = {}
+    for key in pops:
+        output_pops[f'C{key[0]}D{key[1]}'] = pops[key]
+    # write json
+    with open(output_file, 'w') as fp:
+        json.dump(output_pops, fp)
+        
+def json_to_dict(input_file):
+    # read json
+    with open(input_file, 'r') as fp:
+        string_key_dict = json.load(fp)
+    # make keys ordered pairs
+    output_dict = {}
+    for key in string_key_dict:
+        D = key.index('D')
+        output_dict[(key[1:D], key[D+1:])] = string_key_dict[key]
+    return output_dict
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+One-off preprocessing of input layers: repairing invalid geometries,
+projecting to an equal-area CRS and precomputing areas and bounding boxes.
+The results are cached by the contents of the input files, so later runs
+read them back instead of redoing the work.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+# NAD83 / Conus Albers, with Alaska and Hawaii in their own Albers projections
+EQUAL_AREA_CRS = 'EPSG:5070'
+STATE_CRS = {'AK': 'EPSG:3338', 'HI': 'ESRI:102007'}
+
+def file_hash(shapefile):
+    ''' Hashes the contents of a shapefile and its sidecar files
+
+    Arguments:
+        shapefile: path to .shp file
+
+    Output: hex digest
+    '''
+    digest = hashlib.sha1()
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        file = shapefile[:-4] + ext
+        if not os.path.isfile(file):
+            continue
+        digest.update(ext.encode('utf-8'))
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+@contextmanager
+def atomic_path(path):
+    ''' Gives a temporary path to write a file or folder to, and moves what
+    was written there to path once the block exits without error, so
+    readers never see a partial file.  A folder already at path (e.g.
+    written by another process at the same time) is left as it is.
+
+    Arguments:
+        path: path of the file or folder to write
+
+    Output: temporary path next to path, unique to this process and thread
+    '''
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    remove_path(temp)
+    try:
+        yield temp
+        try:
+            os.replace(temp, path)
+        except OSError:
+            # folders cannot replace a folder that is not empty
+            if not os.path.isdir(path):
+                raise
+    finally:
+        remove_path(temp)
+
+def remove_path(path):
+    # remove a file or folder, if there is one
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def repair_geometries(geo_df):
+    ''' Makes invalid geometries valid, keeping only their polygonal parts
+
+    Arguments:
+        geo_df: GeoDataFrame of polygons
+
+    Output: copy of geo_df with valid geometries
+    '''
+    import shapely as shp
+
+    geo_df = geo_df.copy()
+    geoms = geo_df.geometry.values
+    invalid = ~shp.is_valid(geoms)
+    if invalid.any():
+        # make_valid can add stray lines and points along with the polygons
+        geoms[invalid] = [shp.union_all([part for part in shp.get_parts(geom) \
+                                         if part.geom_type in \
+                                         ('Polygon', 'MultiPolygon')]) \
+                          for geom in shp.make_valid(geoms[invalid])]
+        geo_df['geometry'] = geoms
+    return geo_df
+
+def normalize_layer(geo_df, crs=EQUAL_AREA_CRS):
+    ''' Repairs a layer, projects it to an equal-area CRS and adds AREA, MINX,
+    MINY, MAXX and MAXY columns
+
+    Arguments:
+        geo_df: GeoDataFrame of polygons
+        crs: equal-area CRS to project to
+
+    Output: normalized copy of geo_df
+    '''
+    geo_df = repair_geometries(geo_df).to_crs(crs)
+    geo_df['AREA'] = geo_df.geometry.area
+    bounds = geo_df.geometry.bounds
+    geo_df['MINX'] = bounds['minx']
+    geo_df['MINY'] = bounds['miny']
+    geo_df['MAXX'] = bounds['maxx']
+    geo_df['MAXY'] = bounds['maxy']
+    return geo_df
+
+def preprocessed_layer(shapefile, cache_dir, crs=EQUAL_AREA_CRS, \
+                       columns=None):
+    ''' Reads a shapefile normalized by normalize_layer, from the cache if
+    this file has been normalized before
+
+    Arguments:
+        shapefile: path to .shp file
+        cache_dir: folder of normalized layers
+        crs: equal-area CRS to project to
+        columns: list of attribute columns to keep, or None for all
+
+    Output: normalized GeoDataFrame
+    '''
+    import geopandas as gpd
+
+    key = f'{file_hash(shapefile)} {crs} {columns}'
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    name = os.path.basename(shapefile)[:-4] + f'_{digest}.parquet'
+    cache_file = os.path.join(cache_dir, name)
+    if os.path.isfile(cache_file):
+        return gpd.read_parquet(cache_file)
+
+    geo_df = normalize_layer(gpd.read_file(shapefile, columns=columns), crs)
+
+    with atomic_path(cache_file) as temp_file:
+        geo_df.to_parquet(temp_file)
+    return geo_df
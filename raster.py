@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Fast preview of county-district populations on a raster grid, as an
+alternative to the exact vector overlay in geoprocessing.
+"""
+import os
+import numpy as np
+import shapely as shp
+import metrics
+from preprocess import atomic_path
+
+def make_grid(bounds, resolution):
+    ''' Defines a grid of square cells covering a bounding box
+
+    Arguments:
+        bounds: (minx, miny, maxx, maxy), e.g. c_df.total_bounds
+        resolution: side length of a cell, in the units of the CRS
+
+    Output: dictionary with the upper left corner, resolution and shape
+        (rows, columns) of the grid
+    '''
+    minx, miny, maxx, maxy = bounds
+    shape = (max(int(np.ceil((maxy - miny) / resolution)), 1), \
+             max(int(np.ceil((maxx - minx) / resolution)), 1))
+    return {'x0': float(minx), 'y0': float(maxy), \
+            'resolution': float(resolution), 'shape': shape}
+
+def cell_centers(grid, rows, cols):
+    ''' Gets coordinates of the centers of cells in a grid
+
+    Arguments:
+        grid: as outputted by make_grid
+        rows: array of row numbers
+        cols: array of column numbers
+
+    Output: arrays of x and y coordinates
+    '''
+    res = grid['resolution']
+    return grid['x0'] + (cols + 0.5) * res, grid['y0'] - (rows + 0.5) * res
+
+def rasterize(geoms, grid):
+    ''' Labels each cell of a grid with the geometry containing its center
+
+    Arguments:
+        geoms: array of shapely geometries, e.g. c_df.geometry.values
+        grid: as outputted by make_grid
+
+    Output: int32 array of the grid's shape holding the position of the
+        geometry containing each cell center in geoms, or -1 for none
+    '''
+    labels = np.full(grid['shape'], -1, dtype='int32')
+    res = grid['resolution']
+    nrows, ncols = grid['shape']
+    for i, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+
+        # only test cells within the bounds of the geometry
+        minx, miny, maxx, maxy = geom.bounds
+        c0 = max(int((minx - grid['x0']) / res), 0)
+        c1 = min(int((maxx - grid['x0']) / res) + 1, ncols)
+        r0 = max(int((grid['y0'] - maxy) / res), 0)
+        r1 = min(int((grid['y0'] - miny) / res) + 1, nrows)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        rows, cols = np.mgrid[r0:r1, c0:c1]
+        xs, ys = cell_centers(grid, rows, cols)
+
+        shp.prepare(geom)
+        inside = shp.contains_xy(geom, xs, ys)
+        labels[rows[inside], cols[inside]] = i
+    return labels
+
+def population_raster(b_df, grid, pop_str='POP10', cache_file=None, \
+                      key=None):
+    ''' Places the population of each block in the cell holding a point on
+    its surface.  Since this only depends on the blocks, it can be computed
+    once per state and cached.
+
+    Arguments:
+        b_df: GeoDataFrame of the blocks in a state
+        grid: as outputted by make_grid
+        pop_str: the name of the population column in b_df
+        cache_file: path of .npz file to cache the raster in, or None
+        key: string naming the blocks, such as preprocess.file_hash of their
+            shapefile; needed with cache_file
+
+    Output: float64 array of the grid's shape with the population of
+        each cell
+    '''
+    # the cached raster is only used for the same grid, blocks and
+    # population column
+    if cache_file is not None:
+        if key is None:
+            raise ValueError('a key naming the blocks is needed to cache')
+        key = f'{key}:{pop_str}'
+        if os.path.isfile(cache_file):
+            cached = np.load(cache_file)
+            if np.array_equal(cached['grid'], grid_key(grid)) and \
+               'blocks' in cached and str(cached['blocks']) == key:
+                return cached['pops']
+
+    points = shp.point_on_surface(b_df.geometry.values)
+    xs, ys = shp.get_x(points), shp.get_y(points)
+    res = grid['resolution']
+    nrows, ncols = grid['shape']
+    cols = np.clip(((xs - grid['x0']) // res).astype('int64'), 0, ncols - 1)
+    rows = np.clip(((grid['y0'] - ys) // res).astype('int64'), 0, nrows - 1)
+    pops = np.bincount(rows * ncols + cols, \
+                       weights=b_df[pop_str].to_numpy(dtype='float64'), \
+                       minlength=nrows * ncols).reshape(grid['shape'])
+
+    if cache_file is not None:
+        with atomic_path(cache_file) as temp_file, open(temp_file, 'wb') as f:
+            np.savez(f, grid=grid_key(grid), blocks=np.array(key), pops=pops)
+    return pops
+
+def grid_key(grid):
+    # array identifying a grid, saved alongside cached rasters
+    return np.array([grid['x0'], grid['y0'], grid['resolution'], \
+                     *grid['shape']])
+
+def raster_intersection_pops(c_df, d_df, pops_raster, grid, \
+                             c_county_str='COUNTYFP10', county_labels=None):
+    ''' Estimates the population of each county-district intersection by
+    cross-tabulating rasterized counties and districts.
+
+    Arguments:
+        c_df: GeoDataFrame of the counties in a state
+        d_df: GeoDataFrame of the districts in a state
+        pops_raster: as outputted by population_raster
+        grid: as outputted by make_grid
+        c_county_str: name of county column in c_df
+        county_labels: output of rasterize for c_df, which can be passed in
+            to reuse it across plans
+
+    Output: dictionary whose keys are ordered pairs (county, district)
+        and whose values are the populations within these intersections,
+        keyed as in county_district_intersection_pops so it can be passed
+        straight to the functions in metrics
+    '''
+    if county_labels is None:
+        county_labels = rasterize(c_df.geometry.values, grid)
+    district_labels = rasterize(d_df.geometry.values, grid)
+
+    # cross-tabulate cells inside both a county and a district
+    inside = (county_labels >= 0) & (district_labels >= 0)
+    n_districts = len(d_df)
+    table = np.bincount(county_labels[inside] * n_districts + \
+                        district_labels[inside], \
+                        weights=pops_raster[inside], \
+                        minlength=len(c_df) * n_districts)
+
+    counties = list(c_df[c_county_str])
+    districts = list(d_df.index)
+    pops = {}
+    for k in np.flatnonzero(table):
+        i, j = divmod(int(k), n_districts)
+        pops[(counties[i], districts[j])] = table[k]
+    return pops
+
+def raster_error(raster_pops, exact_pops):
+    ''' Compares raster estimates with the exact county-district populations
+
+    Arguments:
+        raster_pops: as outputted by raster_intersection_pops
+        exact_pops: as outputted by county_district_intersection_pops
+
+    Output: dictionary with the largest absolute error in an intersection
+        population, the population missing from the raster estimate, and the
+        absolute error in each metric
+    '''
+    keys = set(raster_pops) | set(exact_pops)
+    errors = [abs(raster_pops.get(key, 0) - exact_pops.get(key, 0)) \
+              for key in keys]
+    error = {'max_pop_error': float(max(errors, default=0)), \
+             'missing_pop': float(sum(exact_pops.values()) - \
+                                  sum(raster_pops.values()))}
+    for metric in [metrics.counties_split, metrics.county_intersections, \
+                   metrics.preserved_pairs, metrics.largest_intersection, \
+                   metrics.min_entropy]:
+        error[metric.__name__] = float(abs(metric(dict(raster_pops)) - \
+                                           metric(dict(exact_pops))))
+    return error
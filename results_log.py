@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only log of county-district populations.  Each worker appends JSON
+Lines records (state, body, year, county, district, population, seconds) to
+its own segment files in a shared results folder, instead of writing one
+JSON file per plan.  Readers scan every segment at once, and compaction
+merges the segments into one file.
+
+A segment is written under a .jsonl.open name and renamed to .jsonl when its
+writer closes it, so compaction only ever takes segments that no writer
+will append to again.  Segments left open by a crashed worker are still
+read, but never compacted.
+
+Records of unit layers other than counties (see overlap.py) carry the name
+of their layer in a units field, and their unit in the county field.
+"""
+import glob
+import json
+import os
+import socket
+import time
+from preprocess import atomic_path
+
+# suffix of segments a writer still has open
+OPEN_SUFFIX = '.open'
+
+class ResultsWriter:
+    ''' Appends the pops of plans to segment files of one worker
+
+    Arguments:
+        directory: results folder shared by all workers
+        worker: name of the worker, used in segment file names (defaults to
+            host name and process id)
+        max_bytes: size at which to start a new segment
+    '''
+    def __init__(self, directory, worker=None, max_bytes=2**26):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.max_bytes = max_bytes
+        self.segment = 0
+        self.file = None
+
+    def open_segment(self):
+        # start a new segment after any this worker wrote in earlier runs;
+        # closed segments may be being compacted, so they are not reopened
+        while True:
+            self.path = os.path.join(self.directory, \
+                                     f'{self.worker}-{self.segment:05d}.jsonl')
+            if not os.path.exists(self.path) and \
+               not os.path.exists(self.path + OPEN_SUFFIX):
+                break
+            self.segment += 1
+        self.file = open(self.path + OPEN_SUFFIX, 'a')
+
+    def write(self, state, body, year, pops, seconds=None, units=None):
+        ''' Appends the records of one plan.  The plan's records are written
+        and flushed to disk together.
+
+        Arguments:
+            state: two-letter abbreviation of the state
+            body: 'congress', 'upper_leg' or 'lower_leg'
+            year: year of the plan
+            pops: dictionary whose keys are ordered pairs (county, district)
+                and whose values are the populations within these
+                intersections
+            seconds: time taken to compute pops, or None
+            units: name of the unit layer pops is keyed by (example:
+                'places'), or None for counties
+        '''
+        if self.file is None or self.file.tell() >= self.max_bytes:
+            self.close()
+            self.open_segment()
+        written = time.time()
+        layer = {} if units is None else {'units': units}
+        lines = [json.dumps({'state': state, 'body': body, 'year': year, \
+                             **layer, \
+                             'county': str(key[0]), 'district': str(key[1]), \
+                             'population': pops[key], 'seconds': seconds, \
+                             'written': written}) + '\n' for key in pops]
+        self.file.write(''.join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        # a closed segment is complete, and can be compacted
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.replace(self.path + OPEN_SUFFIX, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def segments(directory, closed=False):
+    # segment files in a results folder, in a fixed order, leaving out those
+    # still open for writing if closed is True
+    paths = glob.glob(os.path.join(directory, '*.jsonl'))
+    if not closed:
+        paths += glob.glob(os.path.join(directory, '*.jsonl' + OPEN_SUFFIX))
+    return sorted(paths)
+
+def read_segments(paths):
+    # records of segment files, skipping lines cut off by a crashed worker
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def latest_records(records):
+    ''' Keeps only the latest run of each plan and unit layer.  All records
+    of one run of a plan share the time they were written.  A record read
+    twice (from a copied segment) is kept once.
+
+    Arguments:
+        records: iterable of record dictionaries
+
+    Output: list of record dictionaries
+    '''
+    plans = {}
+    for record in records:
+        key = (record['state'], record['body'], record['year'], \
+               record.get('units'))
+        latest = plans.get(key)
+        if latest is None or record['written'] > latest[0]:
+            plans[key] = (record['written'], [record])
+        elif record['written'] == latest[0]:
+            latest[1].append(record)
+    latest = []
+    for _, run in plans.values():
+        pieces = {(record['county'], record['district']): record \
+                  for record in run}
+        latest += pieces.values()
+    return latest
+
+def read_results(directory):
+    ''' Reads the latest run of every plan from all segments in a results
+    folder into one DataFrame
+
+    Arguments:
+        directory: results folder
+
+    Output: DataFrame with one row per record, whose units column is
+        'counties' for county records
+    '''
+    import pandas as pd
+
+    columns = ['state', 'body', 'year', 'units', 'county', 'district', \
+               'population', 'seconds', 'written']
+    records = latest_records(read_segments(segments(directory)))
+    results = pd.DataFrame.from_records(records, columns=columns)
+    results['units'] = results['units'].fillna('counties')
+    return results
+
+def read_pops(directory, units=None):
+    ''' Reads a results folder into pops dictionaries, without pandas
+
+    Arguments:
+        directory: results folder
+        units: name of the unit layer to read (example: 'places'), or None
+            for counties
+
+    Output: dictionary whose keys are (state, body, year) and whose values
+        are pops dictionaries, keyed by (county, district) strings as
+        json_to_dict does
+    '''
+    plans = {}
+    for record in latest_records(read_segments(segments(directory))):
+        if record.get('units') != units:
+            continue
+        pops = plans.setdefault((record['state'], record['body'], \
+                                 record['year']), {})
+        pops[(record['county'], record['district'])] = record['population']
+    return plans
+
+def compact(directory):
+    ''' Merges the closed segments of a results folder into one segment,
+    dropping superseded runs of plans.  Segments that writers still have
+    open are left alone, so compaction can run while workers are writing.
+
+    Arguments:
+        directory: results folder
+
+    Output: path of the compacted segment, or None if there was nothing
+        to merge
+    '''
+    now = time.time()
+    paths = segments(directory, closed=True)
+    if len(paths) < 2:
+        return None
+    records = latest_records(read_segments(paths))
+
+    name = f'compacted-{now:.0f}-{os.getpid()}.jsonl'
+    output = os.path.join(directory, name)
+    with atomic_path(output) as temp, open(temp, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    for path in paths:
+        os.remove(path)
+    return output
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-aware scheduling of (state, body, plan) units on one node.  The peak
+memory of each unit is estimated from the number of blocks and the number
+of vertices in its shapefiles, and units are started, largest first, only
+while their estimates fit in a memory budget.  Big states therefore run
+with few neighbours and small ones are packed densely.
+
+Units are run by forked worker processes.  Units can be grouped (by state,
+in cluster_script.py) so that one long-lived worker runs a group's units
+one after another, keeping what they share (a state's layers, its block
+groups and a results writer) between them; its memory estimate is that of
+its largest unit.  A worker killed for running out of memory fails the unit
+it was on without taking the other workers down, and the rest of its units
+go to a new worker.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import traceback
+from multiprocessing.connection import wait
+from sharding import record_count
+
+# peak memory model: interpreter and libraries, plus a cost per block (row,
+# geometry object and index entry) and per vertex (coordinates, and the
+# copies made by repair, projection and intersection), plus the block groups
+# merged from the blocks and kept for all of a state's plans, which keep
+# about half of the blocks' vertices
+BASE_BYTES = 400 * 2**20
+BLOCK_BYTES = 1500
+VERTEX_BYTES = 64
+GROUP_VERTEX_BYTES = 32
+
+def vertex_count(shapefile):
+    # rough number of vertices, from the size of the .shp file (16 bytes
+    # per point, ignoring record headers)
+    return max(os.path.getsize(shapefile) - 100, 0) // 16
+
+def unit_memory(input_path, state, plan, extra=(), base_bytes=BASE_BYTES, \
+                block_bytes=BLOCK_BYTES, vertex_bytes=VERTEX_BYTES, \
+                group_vertex_bytes=GROUP_VERTEX_BYTES):
+    ''' Estimates the peak memory of computing the pops of a plan, with the
+    state's layers and block groups loaded
+
+    Arguments:
+        input_path: folder holding one folder of shapefiles per state
+        state: two-letter abbreviation of the state
+        plan: name of the plan (example: '2018_congress')
+        extra: names of other shapefiles of the state kept loaded with the
+            blocks (example: ['2010_places'])
+        base_bytes, block_bytes, vertex_bytes, group_vertex_bytes:
+            parameters of the model, with group_vertex_bytes per block
+            vertex (0 if block groups are not used)
+
+    Output: estimated peak memory in bytes
+    '''
+    folder = f'{input_path}/{state}'
+    blocks = record_count(f'{folder}/2010_blocks.shp')
+    block_vertices = vertex_count(f'{folder}/2010_blocks.shp')
+    vertices = block_vertices + sum(vertex_count(f'{folder}/{name}.shp') \
+                                    for name in ['2010_counties', plan, \
+                                                 *extra])
+    return base_bytes + blocks * block_bytes + vertices * vertex_bytes + \
+           block_vertices * group_vertex_bytes
+
+def total_memory():
+    # physical memory of the node, in bytes
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def run_worker(work, units, pipe, finish=None):
+    # body of a worker's process: run its units one after another, sending
+    # (unit, None) as each starts and (unit, (error, peak memory so far,
+    # what work returned)) as it finishes, then call finish
+    for unit in units:
+        pipe.send((unit, None))
+        result = None
+        try:
+            result = work(unit)
+            error = None
+        except BaseException:
+            # keep the message well under the pipe's buffer
+            error = traceback.format_exc()[-10000:]
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        pipe.send((unit, (error, peak, result)))
+    if finish is not None:
+        finish()
+    pipe.close()
+
+def schedule(units, memory, work, budget, max_workers=None, \
+             on_start=None, on_finish=None, group=None, finish=None):
+    ''' Runs units in forked worker processes, starting the largest group of
+    units that fits whenever memory or a worker slot frees up.  A group
+    larger than the whole budget runs on its own.
+
+    Arguments:
+        units: list of units
+        memory: dictionary of the estimated peak memory of each unit
+        work: function called with a unit in its worker, returning
+            something small and picklable (or None).  A worker runs all the
+            units of its group, so work can keep what they share (e.g. in a
+            module-level cache) from one unit to the next.
+        budget: memory that running workers may use between them, in bytes
+        max_workers: largest number of workers to run at once, None for one
+            per core
+        on_start: function called with each unit and the process id
+            running it as it starts, or None
+        on_finish: function called with each unit, its error message (None
+            if it succeeded), its worker's measured peak memory so far and
+            what work returned, or None
+        group: function giving the group of a unit (example: its state),
+            or None to run each unit in a worker of its own.  The units of
+            a group are run in the order they are in units.
+        finish: function called in each worker after its last unit (e.g.
+            to close files work opened), or None
+
+    Output: list of units that failed
+    '''
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0))
+    if group is None:
+        group = lambda unit: unit
+    context = multiprocessing.get_context('fork')
+
+    groups = {}
+    for unit in units:
+        groups.setdefault(group(unit), []).append(unit)
+    # a worker keeps what its units share, so it needs as much memory as
+    # its largest unit for as long as it runs
+    def group_memory(group_units):
+        return max(memory[unit] for unit in group_units)
+    waiting = sorted(groups.values(), \
+                     key=lambda group_units: (-group_memory(group_units), \
+                                              group_units[0]))
+    running = {}
+    used = 0
+    failed = []
+    while waiting or running:
+        # start the largest groups that fit
+        while waiting and len(running) < max_workers:
+            if group_memory(waiting[0]) > budget:
+                # a group larger than the budget waits for the node to itself
+                if running:
+                    break
+                group_units = waiting[0]
+            else:
+                fits = [group_units for group_units in waiting \
+                        if used + group_memory(group_units) <= budget]
+                if not fits:
+                    break
+                group_units = fits[0]
+            waiting.remove(group_units)
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=run_worker, \
+                                      args=(work, group_units, writer, \
+                                            finish))
+            process.start()
+            writer.close()
+            # units not finished yet, and the unit being run
+            running[reader] = (process, list(group_units), None, \
+                               group_memory(group_units))
+            used += group_memory(group_units)
+
+        # wait for units to start or finish, or for a worker to exit
+        for reader in wait(list(running)):
+            process, remaining, current, worker_memory = running[reader]
+            try:
+                unit, report = reader.recv()
+            except EOFError:
+                # the worker is done, or was killed, e.g. for running out of
+                # memory, in which case its unit failed and the others are
+                # put back in the queue
+                running.pop(reader)
+                reader.close()
+                process.join()
+                used -= worker_memory
+                if current is not None:
+                    remaining.remove(current)
+                    failed.append(current)
+                    print(f'{current} failed', file=sys.stderr)
+                    if on_finish is not None:
+                        on_finish(current, 'process exited with code ' \
+                                  f'{process.exitcode}', None, None)
+                if remaining:
+                    waiting.append(remaining)
+                    waiting.sort(key=lambda group_units: \
+                                 (-group_memory(group_units), group_units[0]))
+                continue
+            if report is None:
+                running[reader] = (process, remaining, unit, worker_memory)
+                if on_start is not None:
+                    on_start(unit, process.pid)
+                continue
+            error, peak, result = report
+            remaining.remove(unit)
+            running[reader] = (process, remaining, None, worker_memory)
+            if error is not None:
+                failed.append(unit)
+                print(f'{unit} failed', file=sys.stderr)
+            if on_finish is not None:
+                on_finish(unit, error, peak, result)
+    return failed
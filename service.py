@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service answering queries about county-split metrics from a
+results folder (see results_log.py).  The metrics of every plan are
+computed once at start-up, and county x district tables of plans are kept
+in an LRU cache, so that notebooks and dashboards can ask questions without
+re-reading the results.  It only listens on the loopback interface.
+
+usage: python service.py <results folder> [port]
+
+    GET /metrics?state=PA&body=congress&metric=preserved_pairs
+        metrics of the matching plans; each of state, body, year and
+        metric may be left out or list several values separated by commas
+    GET /table?state=PA&body=congress&year=2018
+        county x district populations of one plan
+    GET /reload
+        re-reads the results folder
+"""
+import json
+import sys
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from metrics import threshold, plan_threshold, split_metrics
+from results_log import read_pops
+
+def metrics_table(plans):
+    ''' Calculates the metrics of every plan, thresholding each as in our
+    analysis
+
+    Arguments:
+        plans: as outputted by read_pops
+
+    Output: list of dictionaries of state, body, year and the metrics of
+        split_metrics, sorted by state, body and year
+    '''
+    rows = []
+    for (state, body, year), pops in sorted(plans.items()):
+        pops = threshold(dict(pops), threshold=plan_threshold(pops))
+        row = {'state': state, 'body': body, 'year': year}
+        row.update(split_metrics(pops))
+        rows.append(row)
+    return rows
+
+def county_district_table(pops):
+    ''' Arranges the pops of a plan as a county x district table
+
+    Arguments:
+        pops: dictionary whose keys are ordered pairs (county, district)
+            and whose values are the populations within these intersections.
+
+    Output: dictionary of counties, districts and pops, a list with one
+        row of populations per county and one column per district
+    '''
+    counties = sorted(set(key[0] for key in pops))
+    districts = sorted(set(key[1] for key in pops))
+    columns = {district: j for j, district in enumerate(districts)}
+    table = {county: [0] * len(districts) for county in counties}
+    for (county, district), pop in pops.items():
+        table[county][columns[district]] = pop
+    return {'counties': counties, 'districts': districts, \
+            'pops': [table[county] for county in counties]}
+
+def split_values(query, name):
+    # values of a query parameter, allowing several separated by commas
+    values = [value for item in query.get(name, []) \
+              for value in item.split(',') if value]
+    return values or None
+
+class MetricsService:
+    ''' Metrics and tables of the plans in a results folder
+
+    Arguments:
+        results_dir: results folder
+        cache_size: number of county x district tables to keep
+    '''
+    def __init__(self, results_dir, cache_size=128):
+        self.results_dir = results_dir
+        self.lock = threading.Lock()
+        self.table = lru_cache(maxsize=cache_size)(self.build_table)
+        self.reload()
+
+    def reload(self):
+        # swap in the new results all at once, so queries running in other
+        # threads see either the old results or the new ones
+        plans = read_pops(self.results_dir)
+        rows = metrics_table(plans)
+        with self.lock:
+            self.plans = plans
+            self.rows = rows
+            self.table.cache_clear()
+
+    def build_table(self, state, body, year):
+        pops = self.plans.get((state, body, year))
+        return None if pops is None else county_district_table(pops)
+
+    def metrics(self, states=None, bodies=None, years=None, metrics=None):
+        ''' Finds the metrics of the plans matching a query
+
+        Arguments:
+            states: list of states to include, or None for all
+            bodies: list of bodies to include, or None for all
+            years: list of years to include, or None for all
+            metrics: list of metrics to include, or None for all
+
+        Output: list of dictionaries of state, body, year and metrics
+        '''
+        rows = self.rows
+        if metrics is not None:
+            unknown = set(metrics) - set(rows[0] if rows else metrics)
+            if unknown:
+                raise KeyError(f'unknown metrics: {sorted(unknown)}')
+        return [{key: value for key, value in row.items() if metrics is None \
+                 or key in metrics or key in ('state', 'body', 'year')} \
+                for row in rows \
+                if (states is None or row['state'] in states) and \
+                   (bodies is None or row['body'] in bodies) and \
+                   (years is None or row['year'] in years)]
+
+class Handler(BaseHTTPRequestHandler):
+    # set by serve
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == '/metrics':
+                years = split_values(query, 'year')
+                body = self.service.metrics( \
+                    split_values(query, 'state'), \
+                    split_values(query, 'body'), \
+                    None if years is None else [int(year) for year in years], \
+                    split_values(query, 'metric'))
+            elif url.path == '/table':
+                body = self.service.table(query['state'][0], \
+                                          query['body'][0], \
+                                          int(query['year'][0]))
+                if body is None:
+                    return self.reply(404, {'error': 'no such plan'})
+            elif url.path == '/reload':
+                self.service.reload()
+                body = {'plans': len(self.service.rows)}
+            else:
+                return self.reply(404, {'error': 'unknown path'})
+        except (KeyError, ValueError) as e:
+            return self.reply(400, {'error': f'bad query: {e.args[0]}'})
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def serve(results_dir, port=8050, cache_size=128):
+    ''' Sets up a server for the metrics of a results folder on localhost
+
+    Arguments:
+        results_dir: results folder
+        port: port to listen on, or 0 to pick a free one
+        cache_size: number of county x district tables to keep
+
+    Output: the server, already listening; call serve_forever on it
+    '''
+    handler = type('Handler', (Handler,), \
+                   {'service': MetricsService(results_dir, cache_size)})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+if __name__ == '__main__':
+    server = serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 \
+                   else 8050)
+    print(f'serving on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting the national set of (state, body, plan) units across the nodes
+of a cluster array job, and merging what the nodes produce.
+"""
+import heapq
+import os
+import shutil
+import struct
+from manifest import open_manifest
+from results_log import read_pops, segments, compact, OPEN_SUFFIX
+
+PLANS = {'congress': ['2018_congress', '2016_congress', '2014_congress', \
+                      '2012_congress', '2010_congress', '2008_congress', \
+                      '2006_congress', '2004_congress', '2002_congress', \
+                      '2000_congress', '1998_congress'],
+         'upper_leg': ['2017_upper_leg', '2016_upper_leg', '2015_upper_leg', \
+                       '2014_upper_leg', '2013_upper_leg', '2010_upper_leg', \
+                       '2006_upper_leg'],
+         'lower_leg': ['2017_lower_leg', '2016_lower_leg', '2015_lower_leg', \
+                       '2014_lower_leg', '2013_lower_leg', '2010_lower_leg', \
+                       '2006_lower_leg']}
+
+def record_count(shapefile):
+    ''' Reads the number of records in a shapefile from the header of its
+    .dbf file, without reading the file itself
+
+    Arguments:
+        shapefile: path to .shp file
+
+    Output: number of records
+    '''
+    with open(shapefile[:-4] + '.dbf', 'rb') as f:
+        header = f.read(8)
+    return struct.unpack('<I', header[4:8])[0]
+
+def available_plans(input_path, state, body):
+    ''' Lists the plans of a body that we have shapefiles for, most recent
+    first
+
+    Arguments:
+        input_path: folder holding one folder of shapefiles per state
+        state: two-letter abbreviation of the state
+        body: 'congress', 'upper_leg' or 'lower_leg'
+
+    Output: list of plan names (example: '2018_congress')
+    '''
+    files = os.listdir(f'{input_path}/{state}')
+    return [plan for plan in PLANS[body] if plan + '.shp' in files]
+
+def work_units(input_path, states, bodies=PLANS):
+    ''' Lists every (state, body, plan) unit we have shapefiles for, along
+    with an estimate of its cost (number of blocks times number of
+    districts)
+
+    Arguments:
+        input_path: folder holding one folder of shapefiles per state
+        states: list of two-letter abbreviations of states
+        bodies: list of bodies to include
+
+    Output: dictionary whose keys are (state, body, plan) tuples and whose
+        values are costs
+    '''
+    costs = {}
+    for state in sorted(states):
+        if not os.path.isdir(f'{input_path}/{state}'):
+            continue
+        blocks = record_count(f'{input_path}/{state}/2010_blocks.shp')
+        for body in bodies:
+            for plan in available_plans(input_path, state, body):
+                districts = record_count(f'{input_path}/{state}/{plan}.shp')
+                costs[(state, body, plan)] = blocks * districts
+    return costs
+
+def assign_shards(costs, n_shards):
+    ''' Splits units across shards so that the shards have about the same
+    total cost, by giving each unit, most expensive first, to the shard with
+    the least work so far.  The result only depends on the units and their
+    costs, so every node computes the same assignment.
+
+    Arguments:
+        costs: as outputted by work_units
+        n_shards: number of shards
+
+    Output: list of n_shards lists of units, each sorted by state so that a
+        node reads each state's blocks once
+    '''
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0, shard) for shard in range(n_shards)]
+    for unit in sorted(costs, key=lambda unit: (-costs[unit], unit)):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(unit)
+        heapq.heappush(loads, (load + costs[unit], shard))
+    return [sorted(units) for units in shards]
+
+def shard_path(output_path, shard):
+    # folder holding the outputs and manifest of one shard
+    return f'{output_path}/shard_{shard}'
+
+def merge_shards(output_path, costs, n_shards):
+    ''' Checks that every unit was finished by the shard it was assigned to,
+    and that each shard only has results for its own units, then combines
+    the shards' result segments into one results folder under output_path,
+    replacing what it held before.
+
+    Arguments:
+        output_path: folder holding the shard folders; the merged results
+            go in its results folder
+        costs: as outputted by work_units
+        n_shards: number of shards the units were split across
+
+    Output: list of problems found; nothing is merged unless this is empty
+    '''
+    problems = []
+    to_copy = []
+    for shard, units in enumerate(assign_shards(costs, n_shards)):
+        path = shard_path(output_path, shard)
+        if not os.path.isfile(f'{path}/manifest.db'):
+            problems.append(f'shard {shard} has no manifest')
+            continue
+        conn = open_manifest(f'{path}/manifest.db')
+        statuses = {unit[:3]: unit[3] for unit in conn.execute( \
+                    'SELECT state, body, plan, status FROM units')}
+        conn.close()
+
+        for state, body, plan in units:
+            status = statuses.get((state, body, plan))
+            if status != 'done':
+                problems.append(f'shard {shard}: {state} {plan} is {status}')
+
+        # plans that repeat the previous plan have no results
+        expected = set((state, body, int(plan[:4])) for state, body, plan \
+                       in units)
+        for key in read_pops(f'{path}/results'):
+            if tuple(key) not in expected:
+                problems.append(f'shard {shard} has results for {key}, ' \
+                                'which is not one of its units')
+        to_copy += [(segment, shard) for segment in \
+                    segments(f'{path}/results')]
+
+    if not problems:
+        # the merged folder is rebuilt from the shards, so merging again
+        # does not copy their segments twice
+        shutil.rmtree(f'{output_path}/results', ignore_errors=True)
+        os.makedirs(f'{output_path}/results')
+        # the shards are finished, so segments they left open are complete
+        for segment, shard in to_copy:
+            name = os.path.basename(segment)
+            if name.endswith(OPEN_SUFFIX):
+                name = name[:-len(OPEN_SUFFIX)]
+            shutil.copyfile(segment, \
+                            f'{output_path}/results/shard_{shard}-{name}')
+        compact(f'{output_path}/results')
+    return problems
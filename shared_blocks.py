@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Block arrays (see block_arrays.py) placed in named shared-memory segments,
+so that worker processes working on one state can map the population,
+county codes, centroids, bounding boxes and packed WKB geometries of its
+blocks without unpickling or re-reading them.
+
+The process that creates the segments owns them and removes them when it
+closes them, exits, or is stopped by SIGTERM or SIGINT; if it is killed
+outright, Python's resource tracker removes them instead.  Workers only
+attach, so a crashing worker leaves the segments alone.  Segment names
+carry the owner's process id, so segments left behind by an owner that no
+longer exists can also be removed with remove_stale_segments.
+"""
+import atexit
+import os
+import secrets
+import signal
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+PREFIX = 'blocks'
+
+class SharedBlocks:
+    ''' Copies block arrays into shared memory, and removes the segments when
+    closed.  Use as a context manager.
+
+    Arguments:
+        arrays: dictionary of arrays, as outputted by load_block_arrays
+        prefix: start of the segment names, without underscores
+
+    Attributes:
+        spec: small picklable dictionary describing the segments, to pass
+            to workers for attach_blocks
+    '''
+    def __init__(self, arrays, prefix=PREFIX):
+        import numpy as np
+
+        self.pid = os.getpid()
+        token = f'{prefix}_{self.pid}_{secrets.token_hex(4)}'
+        self.segments = []
+        self.spec = {'segments': {}, 'crs': arrays.get('crs')}
+        install_handlers()
+        live_owners.add(self)
+        try:
+            for name, array in arrays.items():
+                if name == 'crs':
+                    continue
+                array = np.ascontiguousarray(array)
+                segment = shared_memory.SharedMemory( \
+                    name=f'{token}_{name}', create=True, \
+                    size=max(array.nbytes, 1))
+                self.segments.append(segment)
+                np.ndarray(array.shape, array.dtype, \
+                           buffer=segment.buf)[...] = array
+                self.spec['segments'][name] = [segment.name, \
+                                               list(array.shape), \
+                                               array.dtype.str]
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        # remove the segments; safe to call more than once, and does nothing
+        # in forked children, which inherit the owner but do not own
+        if os.getpid() != self.pid:
+            return
+        while self.segments:
+            segment = self.segments.pop()
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        live_owners.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# owners whose segments are still there, for the exit and signal handlers
+live_owners = set()
+
+def close_live_owners():
+    for owner in list(live_owners):
+        owner.close()
+
+def on_signal(signum, frame):
+    # remove all segments, then stop the way the signal would have
+    close_live_owners()
+    previous = previous_handlers.get(signum)
+    if callable(previous):
+        previous(signum, frame)
+    else:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+previous_handlers = {}
+
+def install_handlers():
+    # once per process; signal handlers can only be set from the main thread
+    if previous_handlers:
+        return
+    atexit.register(close_live_owners)
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(signum, on_signal)
+
+def attach_segment(name):
+    # attach without registering the segment with the resource tracker,
+    # which would otherwise remove it when this worker exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python before 3.13 has no track argument
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def attach_blocks(spec):
+    ''' Maps the shared block arrays in a worker, without copying them
+
+    Arguments:
+        spec: the spec attribute of a SharedBlocks
+
+    Output: dictionary of read-only arrays, as outputted by
+        load_block_arrays, and the list of attached segments, to pass to
+        detach_blocks once the arrays are no longer used
+    '''
+    import numpy as np
+
+    arrays = {'crs': spec['crs']}
+    segments = []
+    for name, (segment_name, shape, dtype) in spec['segments'].items():
+        segment = attach_segment(segment_name)
+        segments.append(segment)
+        array = np.ndarray(tuple(shape), np.dtype(dtype), buffer=segment.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays, segments
+
+def detach_blocks(segments):
+    ''' Unmaps shared block arrays in a worker, leaving them for others.
+    Arrays from attach_blocks must not be used afterwards.
+
+    Arguments:
+        segments: as outputted by attach_blocks
+    '''
+    for segment in segments:
+        segment.close()
+
+def remove_stale_segments(prefix=PREFIX, directory='/dev/shm'):
+    ''' Removes segments whose owner process no longer exists
+
+    Arguments:
+        prefix: start of the segment names
+        directory: where the system keeps shared-memory segments
+
+    Output: list of removed segment names
+    '''
+    removed = []
+    if not os.path.isdir(directory):
+        return removed
+    for name in os.listdir(directory):
+        parts = name.split('_')
+        if not name.startswith(prefix + '_') or len(parts) < 4 or \
+           not parts[1].isdigit():
+            continue
+        try:
+            os.kill(int(parts[1]), 0)
+        except ProcessLookupError:
+            os.remove(os.path.join(directory, name))
+            removed.append(name)
+        except PermissionError:
+            # owned by a live process of another user
+            pass
+    return removed
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+R-tree indexes of block and county bounding boxes, bulk-loaded in one pass
+from arrays.  Indexes can be stored on disk keyed by the hash of their
+bounds, so each is bulk-loaded once and later processes only open it.
+"""
+import hashlib
+import os
+
+def layer_bounds(geo_df):
+    ''' Gets the bounding boxes of a layer, using the MINX, MINY, MAXX and
+    MAXY columns added by preprocess.py when they are there
+
+    Arguments:
+        geo_df: GeoDataFrame
+
+    Output: (rows, 4) array of minx, miny, maxx, maxy
+    '''
+    import numpy as np
+    import shapely as shp
+
+    columns = ['MINX', 'MINY', 'MAXX', 'MAXY']
+    if all(column in geo_df.columns for column in columns):
+        return geo_df[columns].to_numpy(dtype='float64')
+    return np.asarray(shp.bounds(geo_df.geometry.values), dtype='float64')
+
+def bounds_hash(bounds):
+    ''' Hashes an array of bounding boxes
+
+    Arguments:
+        bounds: (rows, 4) array of minx, miny, maxx, maxy
+
+    Output: hex digest
+    '''
+    import numpy as np
+
+    bounds = np.ascontiguousarray(bounds, dtype='float64')
+    return hashlib.sha1(bounds.tobytes()).hexdigest()
+
+def build_index(bounds):
+    ''' Bulk-loads an in-memory R-tree whose ids are the row positions of
+    bounds
+
+    Arguments:
+        bounds: (rows, 4) array of minx, miny, maxx, maxy
+
+    Output: rtree index
+    '''
+    import numpy as np
+    from rtree import index
+
+    # rtree cannot bulk-load an empty stream
+    if len(bounds) == 0:
+        return index.Index()
+    bounds = np.asarray(bounds, dtype='float64')
+    ids = np.arange(len(bounds), dtype='int64')
+    try:
+        return index.Index((ids, np.ascontiguousarray(bounds[:, :2]), \
+                            np.ascontiguousarray(bounds[:, 2:])))
+    except TypeError:
+        # rtree before 1.1 only bulk-loads from a stream of tuples
+        return index.Index((i, tuple(box), None) for i, box in \
+                           zip(ids.tolist(), bounds.tolist()))
+
+def cached_index(bounds, cache_dir, name):
+    ''' Opens an R-tree of bounds stored in cache_dir, bulk-loading and
+    storing it first if it is not stored yet.  Stored indexes are keyed by
+    the hash of their bounds and never modified once written, and each
+    process opens its own temporary copy (rtree opens index files for
+    writing), so any number of processes can share them, from a read-only
+    folder too.
+
+    Arguments:
+        bounds: (rows, 4) array of minx, miny, maxx, maxy
+        cache_dir: folder of stored indexes
+        name: name of the layer (example: '2010_blocks'), used in file names
+
+    Output: rtree index whose ids are the row positions of bounds
+    '''
+    import shutil
+    import tempfile
+    import numpy as np
+    from rtree import index
+    from preprocess import atomic_path
+
+    # rtree cannot bulk-load an empty stream
+    if len(bounds) == 0:
+        return index.Index()
+    bounds = np.ascontiguousarray(bounds, dtype='float64')
+    # each index is a folder holding its .idx and .dat files
+    path = os.path.join(cache_dir, f'{name}_{bounds_hash(bounds)[:16]}')
+    if not os.path.isdir(path):
+        with atomic_path(path) as temp:
+            os.makedirs(temp)
+            ids = np.arange(len(bounds), dtype='int64')
+            index.Index(os.path.join(temp, 'index'), \
+                        (ids, np.ascontiguousarray(bounds[:, :2]), \
+                         np.ascontiguousarray(bounds[:, 2:]))).close()
+
+    copy_dir = tempfile.mkdtemp(prefix=f'{name}_')
+    copy = os.path.join(copy_dir, name)
+    for extension in ('dat', 'idx'):
+        shutil.copyfile(os.path.join(path, f'index.{extension}'), \
+                        f'{copy}.{extension}')
+    idx = index.Index(copy)
+    # the index keeps its files open, so they can go now, and nothing is
+    # left behind by processes that exit without cleaning up
+    shutil.rmtree(copy_dir)
+    return idx
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long a scoring worker takes to import what it needs, and checks
+that it does not pull in the GIS stack.
+
+usage: python startup_time.py [budget in seconds]
+"""
+import os
+import subprocess
+import sys
+
+# folder holding the modules
+here = os.path.dirname(os.path.abspath(__file__))
+
+# modules a scoring worker imports
+core = ['pops_io', 'metrics']
+
+# modules that should only be loaded by geoprocessing work
+heavy = ['shapely', 'geopandas', 'pandas', 'rtree', 'pyproj']
+
+def import_time(modules, runs=5):
+    ''' Times importing modules in fresh interpreters
+
+    Arguments:
+        modules: list of module names
+        runs: number of interpreters to start
+
+    Output: fastest import time in seconds, and the heavy modules that were
+        loaded along the way
+    '''
+    code = f'''
+import sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(','.join(m for m in {heavy!r} if m in sys.modules))
+'''
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], check=True, \
+                                capture_output=True, text=True, \
+                                cwd=here).stdout
+        elapsed, loaded = output.split('\n')[:2]
+        times.append(float(elapsed))
+    return min(times), [m for m in loaded.split(',') if m]
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    for modules in [core, ['geoprocessing']]:
+        elapsed, loaded = import_time(modules)
+        print(f'{", ".join(modules)}: {elapsed:.3f} s', \
+              f'(loaded {", ".join(loaded)})' if loaded else '')
+        if loaded or elapsed > budget:
+            sys.exit(1)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Live progress counters for long batch runs: units done, failed and
+remaining, blocks and intersections processed per second, memory of each
+worker, time since the last progress and an ETA.  A background thread
+rewrites them every few seconds to a file in the Prometheus text exposition
+format, which a local monitoring agent (e.g. node_exporter's textfile
+collector) can scrape.
+"""
+import os
+import threading
+import time
+from preprocess import atomic_path
+
+PREFIX = 'county_splits'
+
+def process_memory(pid):
+    # resident memory of a process in bytes, or None if it is gone
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def format_value(value):
+    # sample value as Prometheus writes it
+    if value != value:
+        return 'NaN'
+    return repr(round(value, 3)) if isinstance(value, float) else str(value)
+
+def labels(**values):
+    # Prometheus label set, with quotes and backslashes escaped
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) \
+               for key, value in values.items()]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+class Telemetry:
+    ''' Counters of a batch run, written to a metrics file in the background
+
+    Arguments:
+        path: metrics file to write (example: 'run/metrics.prom')
+        units: number of units to be run
+        interval: seconds between rewrites of the metrics file
+    '''
+    def __init__(self, path, units, interval=15):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.start = time.time()
+        self.progress = self.start
+        self.units = units
+        self.done = 0
+        self.failed = 0
+        self.blocks = 0
+        self.intersections = 0
+        # (state, body, plan) -> (pid, start time) of units being run
+        self.running = {}
+        # state -> blocks per second of its most recent unit
+        self.state_rates = {}
+
+    def unit_started(self, unit, pid=None):
+        ''' Records that a unit has started
+
+        Arguments:
+            unit: (state, body, plan) tuple
+            pid: process running the unit (defaults to this process)
+        '''
+        with self.lock:
+            self.running[unit] = (pid or os.getpid(), time.time())
+
+    def unit_finished(self, unit, stats=None, error=None):
+        ''' Records that a unit has finished
+
+        Arguments:
+            unit: (state, body, plan) tuple
+            stats: dictionary of the blocks and intersections the unit
+                processed, or None if it skipped the work
+            error: error message if the unit failed, otherwise None
+        '''
+        now = time.time()
+        with self.lock:
+            _, started = self.running.pop(unit, (None, now))
+            self.progress = now
+            if error is not None:
+                self.failed += 1
+                return
+            self.done += 1
+            if stats:
+                self.blocks += stats['blocks']
+                self.intersections += stats['intersections']
+                self.state_rates[unit[0]] = stats['blocks'] / \
+                                            max(now - started, 1e-9)
+
+    def render(self):
+        ''' Formats the counters in the Prometheus text exposition format
+
+        Output: text of the metrics file
+        '''
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.start, 1e-9)
+            finished = self.done + self.failed
+            remaining = self.units - finished
+            eta = elapsed / finished * remaining if finished else \
+                  float('nan')
+            metrics = [
+                ('units', 'gauge', 'units in this run', \
+                 [('', self.units)]),
+                ('units_done_total', 'counter', 'units finished', \
+                 [('', self.done)]),
+                ('units_failed_total', 'counter', 'units that failed', \
+                 [('', self.failed)]),
+                ('units_remaining', 'gauge', 'units not finished yet', \
+                 [('', remaining)]),
+                ('units_running', 'gauge', 'units being run', \
+                 [('', len(self.running))]),
+                ('blocks_processed_total', 'counter', \
+                 'blocks allocated to intersections', [('', self.blocks)]),
+                ('intersections_total', 'counter', \
+                 'county-district intersections found', \
+                 [('', self.intersections)]),
+                ('blocks_per_second', 'gauge', \
+                 'blocks processed per second since the start', \
+                 [('', self.blocks / elapsed)]),
+                ('intersections_per_second', 'gauge', \
+                 'intersections found per second since the start', \
+                 [('', self.intersections / elapsed)]),
+                ('state_blocks_per_second', 'gauge', \
+                 'blocks per second of the latest unit of each state', \
+                 [(labels(state=state), rate) for state, rate in \
+                  sorted(self.state_rates.items())]),
+                ('unit_running_seconds', 'gauge', \
+                 'time each running unit has been running', \
+                 [(labels(state=unit[0], body=unit[1], plan=unit[2]), \
+                   now - started) for unit, (_, started) in \
+                  sorted(self.running.items())]),
+                ('worker_memory_bytes', 'gauge', \
+                 'resident memory of the process running each unit', \
+                 [(labels(pid=pid, state=unit[0], plan=unit[2]), \
+                   process_memory(pid)) for unit, (pid, _) in \
+                  sorted(self.running.items())]),
+                ('seconds_since_progress', 'gauge', \
+                 'time since a unit last finished', \
+                 [('', now - self.progress)]),
+                ('eta_seconds', 'gauge', \
+                 'estimated time until every unit is finished', \
+                 [('', eta)]),
+                ('last_update_timestamp_seconds', 'gauge', \
+                 'time this file was written', [('', now)])]
+
+        lines = []
+        for name, kind, description, samples in metrics:
+            lines.append(f'# HELP {PREFIX}_{name} {description}')
+            lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+            for label_set, value in samples:
+                if value is not None:
+                    lines.append(f'{PREFIX}_{name}{label_set} ' \
+                                 + format_value(value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # the agent never reads a partial file
+        with atomic_path(self.path) as temp, open(temp, 'w') as f:
+            f.write(self.render())
+
+    def loop(self):
+        while not self.stop.wait(self.interval):
+            self.write()
+
+    def __enter__(self):
+        self.write()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+        self.write()